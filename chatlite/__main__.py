@@ -0,0 +1,3 @@
+from chatlite.server import main
+
+main()
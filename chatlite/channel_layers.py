@@ -0,0 +1,285 @@
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import uuid
+from collections import defaultdict
+
+from channels.layers import BaseChannelLayer
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+
+class HashRing:
+    """
+    Consistent hash ring. Each node is placed on the ring at `replicas`
+    points and a key belongs to the first node point at or after its own
+    hash, so adding or removing a node only moves the keys of that node.
+    """
+
+    def __init__(self, nodes, replicas=100):
+        self._points = sorted(
+            (self._hash(f"{node}:{replica}"), node)
+            for node in nodes
+            for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in self._points]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(
+            hashlib.blake2b(key.encode(), digest_size=8).digest(), "big"
+        )
+
+    def get(self, key):
+        """Returns the node owning `key`."""
+        index = bisect.bisect(self._hashes, self._hash(key)) % len(self._points)
+        return self._points[index][1]
+
+
+class ShardedChannelLayer(BaseChannelLayer):
+    """
+    Spreads groups over several channel layers (e.g. one Redis instance
+    each) with consistent hashing, so every operation on a group goes to one
+    shard only. Channels may receive group messages from any shard, so
+    receiving waits on all of them.
+
+    Configured with the child layers as `shards`, in the same form as the
+    entries of CHANNEL_LAYERS, optionally with a stable `NAME`:
+
+        "CONFIG": {
+            "shards": [
+                {"BACKEND": "channels_redis.core.RedisChannelLayer",
+                 "CONFIG": {"hosts": ["redis://redis-1:6379/0"]}},
+                ...
+            ],
+        }
+    """
+
+    extensions = ["groups", "flush"]
+
+    def __init__(self, shards, replicas=100, **kwargs):
+        super().__init__(**kwargs)
+        if not shards:
+            raise ValueError("ShardedChannelLayer needs at least one shard")
+
+        self.shards = {}
+        # Process-local channel names carry the prefix of the layer that made
+        # them, share it so any shard can receive them
+        client_prefix = uuid.uuid4().hex
+        for shard in shards:
+            layer = import_string(shard["BACKEND"])(**shard.get("CONFIG", {}))
+            if hasattr(layer, "client_prefix"):
+                layer.client_prefix = client_prefix
+            self.shards[self._shard_name(shard)] = layer
+        self.ring = HashRing(self.shards, replicas)
+        self._receivers = {}
+
+    def _shard_name(self, shard):
+        if "NAME" in shard:
+            return shard["NAME"]
+        return json.dumps(shard.get("CONFIG", {}), sort_keys=True, default=str)
+
+    def shard_for(self, key):
+        """Returns the layer owning a group or channel name."""
+        return self.shards[self.ring.get(key)]
+
+    async def send(self, channel, message):
+        await self.shard_for(channel).send(channel, message)
+
+    async def receive(self, channel):
+        layers = list(self.shards.values())
+        if len(layers) == 1:
+            return await layers[0].receive(channel)
+
+        # Receivers that lost a race keep waiting for the next call, so no
+        # message they pick up is lost
+        receivers = self._receivers.setdefault(channel, {})
+        for index, layer in enumerate(layers):
+            if index not in receivers:
+                receivers[index] = asyncio.ensure_future(layer.receive(channel))
+        try:
+            done, _ = await asyncio.wait(
+                receivers.values(), return_when=asyncio.FIRST_COMPLETED
+            )
+        except asyncio.CancelledError:
+            for receiver in self._receivers.pop(channel, {}).values():
+                receiver.cancel()
+            raise
+
+        index = next(index for index, task in receivers.items() if task in done)
+        return receivers.pop(index).result()
+
+    async def new_channel(self, prefix="specific"):
+        return await next(iter(self.shards.values())).new_channel(prefix)
+
+    async def group_add(self, group, channel):
+        await self.shard_for(group).group_add(group, channel)
+
+    async def group_discard(self, group, channel):
+        await self.shard_for(group).group_discard(group, channel)
+
+    async def group_send(self, group, message):
+        await self.shard_for(group).group_send(group, message)
+
+    async def flush(self):
+        for receivers in self._receivers.values():
+            for receiver in receivers.values():
+                receiver.cancel()
+        self._receivers.clear()
+        for layer in self.shards.values():
+            await layer.flush()
+
+
+class LocalFanoutChannelLayer(BaseChannelLayer):
+    """
+    Subscribes this process once per group on an inner layer and fans group
+    messages out to the local members in memory, so the inner layer (e.g.
+    Redis) carries one copy of a group message per process rather than one
+    per connection. Direct sends still go through the inner layer.
+
+    Configured with the wrapped layer as `inner`, in the same form as the
+    entries of CHANNEL_LAYERS. Local members share the fanned out message,
+    consumers must not modify the messages they handle.
+    """
+
+    extensions = ["groups", "flush"]
+
+    def __init__(self, inner, refresh_interval=60 * 60, **kwargs):
+        super().__init__(**kwargs)
+        self.inner = import_string(inner["BACKEND"])(**inner.get("CONFIG", {}))
+        # Inner layers expire group memberships, renew this process' ones
+        self.refresh_interval = refresh_interval
+        self._groups = defaultdict(set)
+        self._queues = {}
+        self._direct = {}
+        self._process_channel = None
+        self._task = None
+
+    async def _subscription_channel(self):
+        """
+        Returns the channel this process receives group messages on, starting
+        the task receiving them if needed.
+        """
+        if (
+            self._task is None
+            or self._task.done()
+            or self._task.get_loop() is not asyncio.get_running_loop()
+        ):
+            self._process_channel = asyncio.get_running_loop().create_future()
+            self._task = asyncio.create_task(self._pump(self._process_channel))
+        return await asyncio.shield(self._process_channel)
+
+    async def _pump(self, process_channel):
+        try:
+            channel = await self.inner.new_channel("fanout")
+            # Groups joined on an earlier event loop are joined again
+            for group in list(self._groups):
+                await self.inner.group_add(group, channel)
+        except Exception as exc:
+            process_channel.set_exception(exc)
+            raise
+        process_channel.set_result(channel)
+
+        refresh = asyncio.create_task(self._refresh(channel))
+        try:
+            while True:
+                try:
+                    envelope = await self.inner.receive(channel)
+                    self._deliver(envelope["group"], envelope["message"])
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.exception("Error fanning out group message")
+        finally:
+            refresh.cancel()
+
+    async def _refresh(self, channel):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            for group in list(self._groups):
+                try:
+                    await self.inner.group_add(group, channel)
+                except Exception:
+                    logger.exception("Error renewing group membership")
+
+    def _queue(self, channel):
+        if channel not in self._queues:
+            self._queues[channel] = asyncio.Queue(self.get_capacity(channel))
+        return self._queues[channel]
+
+    def _deliver(self, group, message):
+        for channel in self._groups.get(group, ()):
+            try:
+                self._queue(channel).put_nowait(dict(message))
+            except asyncio.QueueFull:
+                # Full channels drop group messages, like the inner layers
+                pass
+
+    async def send(self, channel, message):
+        await self.inner.send(channel, message)
+
+    async def receive(self, channel):
+        queue = self._queue(channel)
+        if not queue.empty():
+            return queue.get_nowait()
+
+        # Direct sends arrive through the inner layer, that receiver stays
+        # armed across calls so nothing it picks up is lost
+        if channel not in self._direct:
+            self._direct[channel] = asyncio.ensure_future(self.inner.receive(channel))
+        direct = self._direct[channel]
+        local = asyncio.ensure_future(queue.get())
+        try:
+            done, _ = await asyncio.wait(
+                {local, direct}, return_when=asyncio.FIRST_COMPLETED
+            )
+        except asyncio.CancelledError:
+            local.cancel()
+            self._direct.pop(channel).cancel()
+            self._queues.pop(channel, None)
+            raise
+
+        if local in done:
+            return local.result()
+        local.cancel()
+        del self._direct[channel]
+        return direct.result()
+
+    async def new_channel(self, prefix="specific"):
+        return await self.inner.new_channel(prefix)
+
+    async def group_add(self, group, channel):
+        process_channel = await self._subscription_channel()
+        subscribe = not self._groups[group]
+        self._groups[group].add(channel)
+        if subscribe:
+            await self.inner.group_add(group, process_channel)
+
+    async def group_discard(self, group, channel):
+        members = self._groups.get(group)
+        if not members or channel not in members:
+            return
+        members.discard(channel)
+        if not members:
+            del self._groups[group]
+            process_channel = await self._subscription_channel()
+            await self.inner.group_discard(group, process_channel)
+
+    async def group_send(self, group, message):
+        await self.inner.group_send(
+            group, {"type": "fanout.message", "group": group, "message": message}
+        )
+
+    async def flush(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for receiver in self._direct.values():
+            receiver.cancel()
+        self._direct.clear()
+        self._queues.clear()
+        self._groups.clear()
+        await self.inner.flush()
@@ -1,7 +1,13 @@
+from django.utils.functional import SimpleLazyObject
+
+from chats.sidebar import sidebar_channels
+
+
 def sidebar_context(request):
     context = {}
     if request.user.is_authenticated:
-        context["channels"] = request.user.member_of.all()
+        # Only built when a template shows the sidebar
+        context["channels"] = SimpleLazyObject(lambda: sidebar_channels(request.user))
     return context
 
 
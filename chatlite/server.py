@@ -0,0 +1,50 @@
+import argparse
+
+import uvicorn
+from django.conf import settings
+from uvicorn.protocols.websockets.websockets_impl import WebSocketProtocol
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+
+
+class DeflateWebSocketProtocol(WebSocketProtocol):
+    """
+    uvicorn's websockets protocol negotiating permessage-deflate with the
+    parameters of the CHAT_WS_DEFLATE settings instead of the library
+    defaults.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.available_extensions = deflate_extensions()
+
+
+def deflate_extensions():
+    if not getattr(settings, "CHAT_WS_DEFLATE", True):
+        return []
+
+    context_takeover = getattr(settings, "CHAT_WS_DEFLATE_CONTEXT_TAKEOVER", True)
+    return [
+        ServerPerMessageDeflateFactory(
+            server_no_context_takeover=not context_takeover,
+            server_max_window_bits=getattr(settings, "CHAT_WS_DEFLATE_WINDOW_BITS", 15),
+        )
+    ]
+
+
+def main(argv=None):
+    """Runs the ASGI application under uvicorn."""
+    parser = argparse.ArgumentParser(prog="python -m chatlite")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--reload", action="store_true")
+    parser.add_argument("--reload-include", action="append", default=[])
+    args = parser.parse_args(argv)
+
+    uvicorn.run(
+        "chatlite.asgi:application",
+        host=args.host,
+        port=args.port,
+        reload=args.reload,
+        reload_includes=args.reload_include or None,
+        ws=DeflateWebSocketProtocol,
+    )
@@ -98,6 +98,138 @@ CHANNEL_LAYERS = {
     }
 }
 
+# Spread chat groups over several Redis instances, given as a comma separated
+# list of URLs. Each group lives on one instance, picked by consistent hashing
+if os.environ.get("REDIS_SHARD_URLS"):
+    CHANNEL_LAYERS["default"] = {
+        "BACKEND": "chatlite.channel_layers.ShardedChannelLayer",
+        "CONFIG": {
+            "shards": [
+                {
+                    "NAME": url,
+                    "BACKEND": "channels_redis.core.RedisChannelLayer",
+                    "CONFIG": {"hosts": [url]},
+                }
+                for url in os.environ["REDIS_SHARD_URLS"].split(",")
+            ],
+        },
+    }
+
+# Subscribe each process once per group and fan group messages out to its
+# connections in memory, so Redis traffic scales with processes rather than
+# connections
+if os.environ.get("CHANNEL_LAYER_LOCAL_FANOUT", "False") == "True":
+    CHANNEL_LAYERS["default"] = {
+        "BACKEND": "chatlite.channel_layers.LocalFanoutChannelLayer",
+        "CONFIG": {"inner": CHANNEL_LAYERS["default"]},
+    }
+
+
+# Chat
+# Reaction updates for the same message are broadcast at most once per window
+CHAT_REACTION_COALESCE_WINDOW = float(
+    os.environ.get("CHAT_REACTION_COALESCE_WINDOW", "0.1")
+)
+
+# Optionally save incoming messages in batches, trading a few milliseconds of
+# latency for far fewer database round trips under load
+CHAT_MESSAGE_BATCHING = os.environ.get("CHAT_MESSAGE_BATCHING", "False") == "True"
+CHAT_MESSAGE_BATCH_INTERVAL = 0.005
+CHAT_MESSAGE_BATCH_SIZE = 100
+
+# Frames waiting for a slow client, and what happens when they overflow:
+# "coalesce" pending reaction updates, "resync" the client or "disconnect" it
+CHAT_OUTBOUND_QUEUE_SIZE = 100
+CHAT_SLOW_CLIENT_POLICY = os.environ.get("CHAT_SLOW_CLIENT_POLICY", "coalesce")
+
+# Presence and typing state expires after these many seconds, changes are
+# broadcast at most once per tick
+CHAT_PRESENCE_TTL = 60
+CHAT_TYPING_TTL = 5
+CHAT_PRESENCE_TICK = 0.5
+# Presence is shared between processes through Redis when it is configured,
+# otherwise each process only knows its own connections
+CHAT_PRESENCE_REDIS_URL = os.environ.get("REDIS_URL")
+
+# Reconnecting clients catch up on at most this many missed messages, or
+# messages with changed reactions, sent in batches. Larger gaps reload the chat
+CHAT_RESUME_MAX_GAP = 200
+CHAT_RESUME_BATCH_SIZE = 50
+# Connections remember which emojis their user reacted with on at most this many
+# messages, the latest ones when connecting. Others are read when they change
+CHAT_REACTION_STATE_SIZE = 500
+
+# The chat page renders this many of the latest message groups, older ones are
+# loaded a page at a time while scrolling up. Messages are read in chunks
+CHAT_HISTORY_PAGE_GROUPS = 50
+CHAT_HISTORY_CHUNK_SIZE = 200
+
+# Search results are shown this many at a time, and open the chat at the
+# message found with up to this many newer messages after it
+CHAT_SEARCH_PAGE_SIZE = 20
+CHAT_SEARCH_CONTEXT_MESSAGES = 10
+
+# Read positions of connected members are written together every this many
+# seconds, rather than once per message shown
+CHAT_READ_POSITIONS_INTERVAL = 2.0
+
+# Part of the ETags of chat pages, so a deploy never answers 304 Not Modified
+# with markup of the previous release
+CHAT_PAGE_VERSION = os.environ.get("RENDER_GIT_COMMIT", "")
+
+# WebSocket frames are compressed with permessage-deflate when clients offer
+# it. Context takeover lets repeated markup compress against earlier frames,
+# at the cost of a compression context per connection
+CHAT_WS_DEFLATE = os.environ.get("CHAT_WS_DEFLATE", "True") == "True"
+CHAT_WS_DEFLATE_CONTEXT_TAKEOVER = (
+    os.environ.get("CHAT_WS_DEFLATE_CONTEXT_TAKEOVER", "True") == "True"
+)
+CHAT_WS_DEFLATE_WINDOW_BITS = int(os.environ.get("CHAT_WS_DEFLATE_WINDOW_BITS", "15"))
+# Record the raw and compressed size of the frames sent, by event type, for 1 in
+# this many connections. Off by default, as frames are compressed a second time
+# to be measured
+CHAT_FRAME_ACCOUNTING = os.environ.get("CHAT_FRAME_ACCOUNTING", "False") == "True"
+CHAT_FRAME_ACCOUNTING_SAMPLE = int(
+    os.environ.get("CHAT_FRAME_ACCOUNTING_SAMPLE", "100")
+)
+
+# Token buckets limiting the frames users send, per user across channels and
+# per channel across users, as (tokens per second, burst)
+CHAT_RATE_LIMITS = {
+    "message": {"user": (5, 10), "channel": (50, 100)},
+    "reaction": {"user": (10, 20), "channel": (100, 200)},
+}
+# Frames over the limits wait up to this many seconds for their tokens, or are
+# rejected with an error frame
+CHAT_RATE_LIMIT_MAX_DELAY = 0.5
+# "memory" keeps the buckets in each process at no cost per frame. "redis" is a
+# slower fallback sharing approximate counters between processes, so limits
+# hold across them at one Redis round trip per frame
+CHAT_RATE_LIMIT_BACKEND = os.environ.get("CHAT_RATE_LIMIT_BACKEND", "memory")
+CHAT_RATE_LIMIT_REDIS_URL = os.environ.get("REDIS_URL")
+
+
+# Cache
+# Shared chat state (e.g. channel tails) lives in Redis when it is configured,
+# otherwise in the default per-process memory cache
+CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    # Rendered message groups, see chats.fragments
+    "fragments": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "chat-fragments",
+        "OPTIONS": {"MAX_ENTRIES": 10_000},
+    },
+}
+if os.environ.get("REDIS_URL"):
+    CACHES["default"] = {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": os.environ["REDIS_URL"],
+    }
+# Set to "default" to share rendered message groups between processes
+CHAT_FRAGMENT_CACHE = os.environ.get("CHAT_FRAGMENT_CACHE", "fragments")
+CHAT_FRAGMENT_CACHE_TIMEOUT = 60 * 60 * 24
+
 
 # Database
 DATABASES = {"default": dj_database_url.config(default="sqlite:///db.sqlite3")}
@@ -0,0 +1,71 @@
+import asyncio
+import logging
+
+from django.conf import settings
+
+from chats.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ReactionCoalescer:
+    """
+    Collects reaction toggles per message and broadcasts them together with
+    the latest counts at most once per window, so bursts of reactions on a
+    hot message turn into a single update.
+    """
+
+    def __init__(self, window=0.1):
+        self.window = window
+        self._pending = {}
+        self._tasks = set()
+
+    async def add(self, channel_layer, group_name, message_id, toggle, get_counts):
+        """
+        Queues a toggle for broadcast. `get_counts` is awaited with the message
+        id when the window closes and must return the current reaction counts
+        and the reaction sequence number of the message.
+        """
+        metrics.incr("reactions.toggles")
+        key = (group_name, message_id)
+        pending = self._pending.get(key)
+        if pending is not None:
+            pending.append(toggle)
+            metrics.incr("reactions.broadcasts_suppressed")
+            return
+
+        self._pending[key] = [toggle]
+        if self.window <= 0:
+            await self._flush(channel_layer, key, get_counts)
+            return
+
+        task = asyncio.create_task(self._flush(channel_layer, key, get_counts))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self, channel_layer, key, get_counts):
+        group_name, message_id = key
+        try:
+            if self.window > 0:
+                await asyncio.sleep(self.window)
+            toggles = self._pending.pop(key)
+            reaction_counts, reaction_seq = await get_counts(message_id)
+            await channel_layer.group_send(
+                group_name,
+                {
+                    "type": "reaction_update",
+                    "message_id": str(message_id),
+                    "reaction_counts": reaction_counts,
+                    "reaction_seq": reaction_seq,
+                    "toggles": toggles,
+                },
+            )
+            metrics.incr("reactions.broadcasts")
+        except Exception:
+            self._pending.pop(key, None)
+            logger.exception("Error broadcasting reaction update")
+
+
+reaction_coalescer = ReactionCoalescer(
+    window=getattr(settings, "CHAT_REACTION_COALESCE_WINDOW", 0.1)
+)
@@ -0,0 +1,71 @@
+import random
+import zlib
+
+from django.conf import settings
+
+from chats.metrics import metrics
+
+# permessage-deflate ends each compressed message without this flush marker
+DEFLATE_TRAILER = b"\x00\x00\xff\xff"
+
+
+class FrameSizes:
+    """
+    Accounts the raw and compressed size of the frames sent to one client, by
+    event type. ASGI servers do not report the bytes they put on the wire, so
+    frames are compressed here the way permessage-deflate compresses them:
+    raw deflate with a sync flush, keeping the compression context between
+    frames unless context takeover is off.
+    """
+
+    def __init__(self, compressed=True, context_takeover=True, window_bits=15):
+        self.compressed = compressed
+        self.context_takeover = context_takeover
+        self.window_bits = window_bits
+        self._compressor = None
+
+    def _compress(self, data):
+        if self._compressor is None or not self.context_takeover:
+            self._compressor = zlib.compressobj(wbits=-self.window_bits)
+        data = self._compressor.compress(data) + self._compressor.flush(
+            zlib.Z_SYNC_FLUSH
+        )
+        return data.removesuffix(DEFLATE_TRAILER)
+
+    def record(self, kind, text):
+        """Counts a frame of event type `kind` and returns its two sizes."""
+        data = text.encode()
+        raw_bytes = len(data)
+        compressed_bytes = len(self._compress(data)) if self.compressed else raw_bytes
+
+        metrics.incr(f"frames.{kind}.count")
+        metrics.incr(f"frames.{kind}.raw_bytes", raw_bytes)
+        metrics.incr(f"frames.{kind}.compressed_bytes", compressed_bytes)
+        return raw_bytes, compressed_bytes
+
+
+def offers_deflate(scope):
+    """Whether the client offered permessage-deflate in its handshake."""
+    for name, value in scope.get("headers", []):
+        if name == b"sec-websocket-extensions" and b"permessage-deflate" in value:
+            return True
+    return False
+
+
+def create_frame_sizes(scope):
+    """
+    Creates the frame accounting of a connection configured from the
+    settings, or None when accounting is off. Compressing every frame a
+    second time costs a compression context per connection and loop time
+    per frame, so only 1 in `CHAT_FRAME_ACCOUNTING_SAMPLE` connections is
+    accounted.
+    """
+    if not getattr(settings, "CHAT_FRAME_ACCOUNTING", False):
+        return None
+    if random.randrange(getattr(settings, "CHAT_FRAME_ACCOUNTING_SAMPLE", 100)):
+        return None
+    return FrameSizes(
+        compressed=getattr(settings, "CHAT_WS_DEFLATE", True) and offers_deflate(scope),
+        context_takeover=getattr(settings, "CHAT_WS_DEFLATE_CONTEXT_TAKEOVER", True),
+        window_bits=getattr(settings, "CHAT_WS_DEFLATE_WINDOW_BITS", 15),
+    )
@@ -0,0 +1,91 @@
+import hashlib
+
+from django.conf import settings
+from django.db.models import Max
+from django.utils import timezone
+from django.utils.decorators import method_decorator
+from django.views.decorators.cache import cache_control
+from django.views.decorators.http import condition
+from django.views.decorators.vary import vary_on_headers
+
+from chats.models import Channel
+
+
+def page_etag(request, *validators):
+    """
+    Builds the ETag of a page from the `validators` of the data it shows and
+    everything else it varies on: the deployed code, the user, their
+    timezone and CSRF cookie. Full page loads also show the sidebar, which
+    the validators do not cover, so only HTMX requests get an ETag.
+    """
+    if request.headers.get("HX-Request") != "true":
+        return None
+
+    parts = (
+        getattr(settings, "CHAT_PAGE_VERSION", ""),
+        request.user.pk,
+        timezone.get_current_timezone_name(),
+        request.COOKIES.get(settings.CSRF_COOKIE_NAME),
+        validators,
+    )
+    return hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+
+
+def _channel_validators(request, channel_id, *fields):
+    """
+    Returns the values of `fields` of a channel the user is a member of, or
+    None to let the view handle missing channels and outsiders. The field
+    "profiles_updated_at" is the last change to a member's profile.
+    """
+    if not Channel.is_member(channel_id, request.user.id):
+        return None
+    channels = Channel.objects.filter(id=channel_id)
+    if "profiles_updated_at" in fields:
+        channels = channels.annotate(
+            profiles_updated_at=Max("members__profile__updated_at")
+        )
+    return channels.values_list(*fields).first()
+
+
+def chat_etag(request, channel_id):
+    # New and deleted messages, reactions, renames, the member count and
+    # the names and pictures of senders
+    validators = _channel_validators(
+        request,
+        channel_id,
+        "last_seq",
+        "message_count",
+        "reaction_seq",
+        "member_count",
+        "updated_at",
+        "profiles_updated_at",
+    )
+    return validators and page_etag(request, request.GET.urlencode(), *validators)
+
+
+def history_etag(request, channel_id):
+    # Older pages only change with reactions and senders' profiles
+    validators = _channel_validators(
+        request, channel_id, "reaction_seq", "profiles_updated_at"
+    )
+    return validators and page_etag(request, request.GET.urlencode(), *validators)
+
+
+def details_etag(request, channel_id):
+    validators = _channel_validators(request, channel_id, "updated_at")
+    return validators and page_etag(request, *validators)
+
+
+def conditional_page(etag_func):
+    """
+    Decorates the `get` of a view to answer 304 Not Modified, without
+    running the view, when the client's copy still matches `etag_func`.
+    Browsers are told to revalidate their copy on every visit.
+    """
+
+    def decorator(view):
+        view = condition(etag_func=etag_func)(view)
+        view = cache_control(private=True, no_cache=True)(view)
+        return vary_on_headers("HX-Request")(view)
+
+    return method_decorator(decorator)
@@ -1,16 +1,30 @@
+import asyncio
 import json
 import logging
-import uuid
-from datetime import datetime
-from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from collections import OrderedDict
+from datetime import timezone as dt_timezone
+from urllib.parse import parse_qs
 
-from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db import transaction
 from django.template.loader import render_to_string
+from django.urls import reverse
 from django.utils import timezone
 
-from chats.models import Channel, Message, Reaction
+from chats.broadcast import reaction_coalescer
+from chats.compression import create_frame_sizes
+from chats.grouping import MessageGrouper
+from chats.models import Channel, Message, Reaction, ReactionSummary
+from chats.outbound import create_outbound_queue
+from chats.pipeline import message_writer
+from chats.presence import presence_ticker
+from chats.protocol import negotiate
+from chats.ratelimit import rate_limiter
+from chats.tail import tail_store
+from chats.unread import read_positions
 
 UserModel = get_user_model()
 logger = logging.getLogger(__name__)
@@ -20,20 +34,190 @@ class ChatConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         self.channel_id = self.scope["url_route"]["kwargs"]["channel_id"]
         self.channel_group_name = f"chat_{self.channel_id}"
+        # HTML fragments for HTMX by default, compact JSON deltas on request
+        self.protocol = negotiate(self.scope)
+
+        # Only members may listen to a channel
+        if not await self._is_member():
+            await self.close()
+            return
+
+        # Emojis this user reacted with, per message id, kept current from
+        # the reaction events. Only the latest messages, which the page shows,
+        # are loaded up front and at most `reaction_state_size` are kept
+        self.reaction_state_size = getattr(settings, "CHAT_REACTION_STATE_SIZE", 500)
+        self.user_reacted_emojis = await self._get_user_reacted_emojis()
 
         # Join channel group
         await self.channel_layer.group_add(self.channel_group_name, self.channel_name)
 
-        await self.accept()
+        await self.accept(subprotocol=self.protocol.subprotocol)
+
+        self.frame_sizes = create_frame_sizes(self.scope)
+        # Frames go out through a bounded queue so a slow client cannot hold
+        # up the handling of channel layer events
+        self.outbound = create_outbound_queue(
+            self._send_frame, self._close_slow_client, self._resync_frame()
+        )
+        self.outbound.start()
+
+        # Messages sent while catching up, their live events are skipped
+        self.resumed_seqs = set()
+        # Reaction sequence number of the last cursor sent to the client
+        self.reaction_seq = 0
+        await self._resume()
+
+        user = self.scope["user"]
+        user_profile_data = await database_sync_to_async(self._get_user_profile_data)(
+            user
+        )
+        await presence_ticker.join(
+            self.channel_layer,
+            self.channel_id,
+            str(user.id),
+            user_profile_data["display_name"],
+        )
 
     async def disconnect(self, close_code):
+        if getattr(self, "outbound", None) is not None:
+            await self.outbound.stop()
+            await presence_ticker.leave(self.channel_id, str(self.scope["user"].id))
+
         # Leave channel group
         await self.channel_layer.group_discard(
             self.channel_group_name, self.channel_name
         )
 
-    @sync_to_async
+    async def _send_frame(self, frame):
+        # Frames are queued with the event type they were built for
+        kind, text_data = frame
+        if self.frame_sizes is not None:
+            self.frame_sizes.record(kind, text_data)
+        await self.send(text_data=text_data)
+
+    async def _close_slow_client(self):
+        await self.close(code=4008)
+
+    def _resync_frame(self):
+        url = reverse("chats:channel-chat", kwargs={"channel_id": self.channel_id})
+        return "resync", self.protocol.resync(url)
+
+    async def _resume(self):
+        """
+        Sends a reconnecting client what it missed since the sequence numbers
+        in its query string, in batches, or tells it to reload when it missed
+        too much. Runs before any channel layer event is handled, so missed
+        messages are sent before the live ones.
+        """
+        query = parse_qs(self.scope.get("query_string", b"").decode())
+        try:
+            seq = int(query["seq"][0])
+            reaction_seq = int(query["reaction_seq"][0])
+        except (KeyError, ValueError):
+            return
+
+        missed = await self._get_missed(seq, reaction_seq)
+        if missed is None:
+            self.outbound.put(self._resync_frame())
+            return
+
+        frames, self.resumed_seqs, reaction_seq = missed
+        if self.resumed_seqs:
+            read_positions.report(
+                self.channel_id, self.scope["user"].id, max(self.resumed_seqs)
+            )
+        batch_size = getattr(settings, "CHAT_RESUME_BATCH_SIZE", 50)
+        for start in range(0, len(frames), batch_size):
+            batch = self.protocol.batch(frames[start : start + batch_size])
+            self.outbound.put(("resume", batch))
+        self.reaction_seq = reaction_seq
+        self.outbound.put(("resume", self.protocol.cursor(reaction_seq)))
+
+    @database_sync_to_async
+    def _get_missed(self, seq, reaction_seq):
+        """
+        Loads the frames of the messages after `seq` and of the reaction
+        changes after `reaction_seq`, or None when either gap is too large.
+        Returns the frames, the sequence numbers of the messages and the
+        current reaction sequence number of the channel.
+        """
+        max_gap = getattr(settings, "CHAT_RESUME_MAX_GAP", 200)
+        channel = Channel.objects.values("last_seq", "reaction_seq").get(
+            id=self.channel_id
+        )
+        if channel["last_seq"] - seq > max_gap:
+            return None
+
+        messages = []
+        if channel["last_seq"] > seq:
+            messages = list(
+                Message.objects.filter(channel_id=self.channel_id, seq__gt=seq)
+                .order_by("seq")
+                .select_related("sender__profile")
+            )
+        changed = []
+        if channel["reaction_seq"] > reaction_seq:
+            # Reactions on the missed messages come with the messages
+            changed = list(
+                Message.objects.filter(
+                    channel_id=self.channel_id,
+                    seq__lte=seq,
+                    reaction_seq__gt=reaction_seq,
+                )
+                .order_by("seq")
+                .values_list("id", flat=True)[: max_gap + 1]
+            )
+            if len(changed) > max_gap:
+                return None
+        message_ids = [message.id for message in messages] + changed
+        reaction_counts = ReactionSummary.counts_for(message_ids)
+        user_reacted_emojis = Reaction.emojis_by(self.scope["user"].id, message_ids)
+        for message_id in message_ids:
+            self._track_reacted_emojis(
+                str(message_id), user_reacted_emojis.get(message_id, set())
+            )
+
+        frames = []
+        grouper = MessageGrouper(
+            tail_store.tail_before(self.channel_id, messages[0]) if messages else None
+        )
+        for index, message in enumerate(messages):
+            should_group, group_id = grouper.add(message)
+
+            event = self._message_event(
+                message,
+                should_group,
+                group_id,
+                # A client without messages still shows the placeholder
+                is_first_message=seq == 0 and index == 0,
+                reaction_counts=reaction_counts.get(message.id, {}),
+                user_reacted_emojis=user_reacted_emojis.get(message.id, ()),
+            )
+            frames.append(self.protocol.message(event))
+
+        user_id = str(self.scope["user"].id)
+        for message_id in changed:
+            frames.append(
+                self.protocol.reactions(
+                    str(message_id),
+                    reaction_counts.get(message_id, {}),
+                    user_reacted_emojis.get(message_id, set()),
+                    user_id,
+                )
+            )
+        return frames, {message.seq for message in messages}, channel["reaction_seq"]
+
+    @database_sync_to_async
+    def _is_member(self):
+        user = self.scope["user"]
+        return user.is_authenticated and Channel.is_member(self.channel_id, user.id)
+
     def _get_user_profile_data(self, user):
+        # Cached for the connection user, the sender of every live message
+        is_own = user.pk == self.scope["user"].pk
+        if is_own and getattr(self, "_user_profile_data", None) is not None:
+            return self._user_profile_data
+
         display_name = user.username
         profile_picture = "/static/images/default_avatar.png"
 
@@ -41,56 +225,200 @@ class ChatConsumer(AsyncWebsocketConsumer):
             display_name = user.profile.display_name
             if user.profile.profile_picture:
                 profile_picture = user.profile.profile_picture
-        return {"display_name": display_name, "profile_picture": profile_picture}
-
-    async def _save_message(self, channel_id, sender, content):
-        channel = await sync_to_async(Channel.objects.get)(id=channel_id)
-        message = await sync_to_async(Message.objects.create)(
-            channel=channel, sender=sender, content=content
+        user_profile_data = {
+            "display_name": display_name,
+            "profile_picture": profile_picture,
+        }
+        if is_own:
+            self._user_profile_data = user_profile_data
+        return user_profile_data
+
+    @database_sync_to_async
+    def _get_user_reacted_emojis(self):
+        """
+        Loads the emojis the user reacted with on the latest messages of the
+        channel, by message id from oldest to newest.
+        """
+        latest = (
+            Message.objects.filter(channel_id=self.channel_id)
+            .order_by("-seq")
+            .values_list("id", flat=True)[: self.reaction_state_size]
         )
-        return message
-
-    async def _get_message_with_reactions(self, message_id, current_user_id):
-        message = await sync_to_async(Message.objects.get)(id=message_id)
-        reactions = await sync_to_async(list)(
-            message.message_reactions.select_related("reactor")
+        latest = list(latest)[::-1]
+        user_reacted_emojis = Reaction.emojis_by(self.scope["user"].id, latest)
+        return OrderedDict(
+            (str(message_id), user_reacted_emojis.get(message_id, set()))
+            for message_id in latest
         )
 
-        reaction_counts = {}
-        user_reacted_emojis = set()
-
-        for reaction in reactions:
-            reaction_counts.setdefault(reaction.emoji, 0)
-            reaction_counts[reaction.emoji] += 1
-            if reaction.reactor.id == current_user_id:
-                user_reacted_emojis.add(reaction.emoji)
-
-        return message, reaction_counts, user_reacted_emojis
+    @database_sync_to_async
+    def _load_reacted_emojis(self, message_id):
+        return Reaction.emojis_by(self.scope["user"].id, [message_id]).get(
+            int(message_id), set()
+        )
 
-    async def _get_last_two_messages(self, channel_id):
-        try:
-            messages = await sync_to_async(list)(
-                Message.objects.select_related("sender")
-                .filter(channel_id=channel_id)
-                .order_by("-timestamp")[:2]
+    def _track_reacted_emojis(self, message_id, emojis):
+        """Remembers the user's emojis on a message, forgetting the oldest."""
+        self.user_reacted_emojis[message_id] = emojis
+        self.user_reacted_emojis.move_to_end(message_id)
+        while len(self.user_reacted_emojis) > self.reaction_state_size:
+            self.user_reacted_emojis.popitem(last=False)
+
+    @database_sync_to_async
+    def _create_message(self, content):
+        """
+        Saves a message and prepares its broadcast in one unit of work.
+        """
+        # The sequence number is reserved in the same transaction as the
+        # insert, so a failed insert never leaves a gap. Deleted messages
+        # are uncounted, the first message is the only one counted
+        with transaction.atomic():
+            seq, message_count = Channel.reserve_seq(self.channel_id)
+            message = Message.objects.create(
+                channel_id=self.channel_id,
+                sender=self.scope["user"],
+                content=content,
+                seq=seq,
             )
-            return messages
-        except Message.DoesNotExist:
-            return None
+        return self._prepare_message(message, message_count == 1)
+
+    def _prepare_message(self, message, is_first_message):
+        """
+        Advances the channel tail and builds the broadcast event of a new
+        message, with the fragment rendered once for the whole group.
+        """
+        should_group, group_id = tail_store.advance(self.channel_id, message)
+        return self._message_event(message, should_group, group_id, is_first_message)
+
+    def _message_event(
+        self,
+        message,
+        should_group,
+        group_id,
+        is_first_message,
+        reaction_counts=None,
+        user_reacted_emojis=(),
+    ):
+        return {
+            "type": "chat_message",
+            "message_id": str(message.id),
+            "seq": message.seq,
+            "html": self._render_message(
+                message, should_group, group_id, reaction_counts, user_reacted_emojis
+            ),
+            "should_group": should_group,
+            "group_id": group_id,
+            "is_first_message": is_first_message,
+            # Structured fields for clients rendering the message themselves
+            "message": self._message_data(
+                message, reaction_counts, user_reacted_emojis
+            ),
+        }
+
+    def _render_message(
+        self,
+        message,
+        should_group,
+        group_id,
+        reaction_counts=None,
+        user_reacted_emojis=(),
+    ):
+        """
+        Renders the fragment of a message. Timestamps are rendered in UTC and
+        localized by the client.
+        """
+        sender = message.sender
+        with timezone.override(dt_timezone.utc):
+            if should_group:
+                return render_to_string(
+                    "chats/partials/_single_message.html",
+                    {
+                        "message_id": message.id,
+                        "seq": message.seq,
+                        "message_content": message.content,
+                        "sender_id": sender.id,
+                        "timestamp": message.timestamp,
+                        "reaction_counts": reaction_counts or {},
+                        "user_reacted_emojis": user_reacted_emojis,
+                    },
+                )
 
-    async def _toggle_reaction(self, message_id, reactor, emoji):
-        message = await sync_to_async(Message.objects.get)(id=message_id)
-        try:
-            reaction = await sync_to_async(Reaction.objects.get)(
-                message=message, reactor=reactor, emoji=emoji
+            user_profile_data = self._get_user_profile_data(sender)
+            group = {
+                "id": group_id,
+                "avatar": user_profile_data["profile_picture"],
+                "display_name": user_profile_data["display_name"],
+                "start_timestamp": message.timestamp,
+                "messages": [
+                    {
+                        "id": message.id,
+                        "seq": message.seq,
+                        "content": message.content,
+                        "sender": {"id": sender.id},
+                        "timestamp": message.timestamp,
+                        "reaction_counts": reaction_counts or {},
+                        "user_reacted_emojis": user_reacted_emojis,
+                    }
+                ],
+            }
+            return render_to_string(
+                "chats/partials/_message_group.html", {"group": group}
             )
-            await sync_to_async(reaction.delete)()
-            return False  # Reaction removed
-        except Reaction.DoesNotExist:
-            await sync_to_async(Reaction.objects.create)(
-                message=message, reactor=reactor, emoji=emoji
+
+    def _message_data(self, message, reaction_counts=None, user_reacted_emojis=()):
+        sender = message.sender
+        user_profile_data = self._get_user_profile_data(sender)
+        data = {
+            "id": message.id,
+            "seq": message.seq,
+            "sender_id": str(sender.id),
+            "display_name": user_profile_data["display_name"],
+            "avatar": user_profile_data["profile_picture"],
+            "content": message.content,
+            "timestamp": message.timestamp.astimezone(dt_timezone.utc).isoformat(),
+        }
+        if reaction_counts:
+            data["reaction_counts"] = reaction_counts
+            data["user_reacted_emojis"] = sorted(user_reacted_emojis)
+        return data
+
+    @database_sync_to_async
+    def _get_reaction_counts(self, message_id):
+        """
+        Returns the reaction counts of a message and the reaction sequence
+        number of its last change, which clients resume from.
+        """
+        reaction_counts = dict(
+            ReactionSummary.objects.filter(message_id=message_id)
+            .order_by("id")
+            .values_list("emoji", "count")
+        )
+        reaction_seq = Message.objects.values_list("reaction_seq", flat=True).get(
+            pk=message_id
+        )
+        return reaction_counts, reaction_seq
+
+    @database_sync_to_async
+    def _toggle_reaction(self, message_id, reactor, emoji):
+        return Reaction.toggle(message_id, reactor.id, emoji, self.channel_id)
+
+    async def _throttle(self, kind):
+        """
+        Returns whether a frame of `kind` is within the rate limits, waiting
+        for its tokens if it is allowed to. Rejected frames get an error
+        frame back.
+        """
+        allowed, wait = await rate_limiter.acquire(
+            kind, str(self.scope["user"].id), self.channel_id
+        )
+        if not allowed:
+            self.outbound.put(
+                ("error", self.protocol.error("rate_limited", kind, wait))
             )
-            return True  # Reaction added
+            return False
+        if wait:
+            await asyncio.sleep(wait)
+        return True
 
     # Receive message from WebSocket
     async def receive(self, text_data):
@@ -98,49 +426,55 @@ class ChatConsumer(AsyncWebsocketConsumer):
             text_data_json = json.loads(text_data)
             message_type = text_data_json.get("type")
 
-            if message_type == "message":
-                message_content = text_data_json["content"]
-                sender = self.scope["user"]
+            if message_type in ("message", "reaction"):
+                if not await self._throttle(message_type):
+                    return
 
-                # Save message to database
-                message = await self._save_message(
-                    self.channel_id, sender, message_content
+            if message_type == "typing":
+                await presence_ticker.typing(
+                    self.channel_id, str(self.scope["user"].id)
                 )
-
-                user_profile_data = await self._get_user_profile_data(sender)
-
-                await self.channel_layer.group_send(
-                    self.channel_group_name,
-                    {
-                        "type": "chat_message",
-                        "message_id": str(message.id),
-                        "message_content": message.content,
-                        "sender_id": str(sender.id),
-                        "sender_username": sender.username,
-                        "sender_display_name": user_profile_data["display_name"],
-                        "sender_avatar": user_profile_data["profile_picture"],
-                        "timestamp": message.timestamp.isoformat(),
-                    },
+            elif message_type == "message":
+                message_content = text_data_json["content"]
+                await presence_ticker.stop_typing(
+                    self.channel_id, str(self.scope["user"].id)
                 )
+
+                if message_writer.enabled:
+                    # Saved in a batch with other messages of this process
+                    message, is_first_message = await message_writer.save(
+                        self.channel_id, self.scope["user"], message_content
+                    )
+                    event = await database_sync_to_async(self._prepare_message)(
+                        message, is_first_message
+                    )
+                else:
+                    event = await self._create_message(message_content)
+
+                await self.channel_layer.group_send(self.channel_group_name, event)
             elif message_type == "reaction":
                 message_id = text_data_json["message_id"]
                 emoji = text_data_json["emoji"]
                 reactor = self.scope["user"]
 
-                await self._toggle_reaction(message_id, reactor, emoji)
-
-                # Fetch updated reactions and send update to group
-                _, reaction_counts, user_reacted_emojis = (
-                    await self._get_message_with_reactions(message_id, reactor.id)
-                )
-
-                await self.channel_layer.group_send(
+                added = await self._toggle_reaction(message_id, reactor, emoji)
+                if added is None:
+                    # Not in this channel, or toggled concurrently
+                    logger.warning(
+                        "Reaction to message %s in channel %s changed nothing",
+                        message_id,
+                        self.channel_id,
+                    )
+                    return
+
+                # Broadcast the latest counts once per coalescing window,
+                # recipients apply the toggles to their own reaction state
+                await reaction_coalescer.add(
+                    self.channel_layer,
                     self.channel_group_name,
-                    {
-                        "type": "reaction_update",
-                        "message_id": str(message_id),
-                        "reaction_counts": reaction_counts,
-                    },
+                    str(message_id),
+                    {"reactor_id": str(reactor.id), "emoji": emoji, "added": added},
+                    self._get_reaction_counts,
                 )
         except Exception:
             logger.exception("Error in receive")
@@ -148,85 +482,14 @@ class ChatConsumer(AsyncWebsocketConsumer):
     # Receive message from channel group
     async def chat_message(self, event):
         try:
-            # Activate timezone from user's cookie
-            tzname = self.scope["cookies"].get("django_timezone")
-            if tzname:
-                try:
-                    timezone.activate(ZoneInfo(tzname))
-                except ZoneInfoNotFoundError:
-                    timezone.deactivate()
-            else:
-                timezone.deactivate()
-
-            message_id = event["message_id"]
-            message_content = event["message_content"]
-            sender_id = event["sender_id"]
-            sender_display_name = event["sender_display_name"]
-            sender_avatar = event["sender_avatar"]
-            timestamp_str = event["timestamp"]
-            timestamp = datetime.fromisoformat(timestamp_str)
-
-            messages = await self._get_last_two_messages(self.channel_id)
-            should_group = False
-
-            if len(messages) == 2:
-                new_message = messages[0]
-                previous_message = messages[1]
-
-                if str(new_message.id) == message_id:
-                    time_diff = new_message.timestamp - previous_message.timestamp
-                    if (
-                        previous_message.sender.id == uuid.UUID(sender_id)
-                        and time_diff.total_seconds() < 60 * 5
-                    ):
-                        should_group = True
-
-            html = ""
-            if should_group:
-                # Render only the single message and append it to the last group
-                single_message_html = await sync_to_async(render_to_string)(
-                    "chats/partials/_single_message.html",
-                    {
-                        "message_id": message_id,
-                        "message_content": message_content,
-                        "sender_id": sender_id,
-                        "timestamp": timestamp,
-                        "reaction_counts": {},
-                        "user_reacted_emojis": [],
-                    },
-                )
-                html = f'<div hx-swap-oob="beforeend:.message-group:last-child .messages">{single_message_html}</div>'
-            else:
-                # Render a new message group and append it to the chat log
-                group = {
-                    "avatar": sender_avatar,
-                    "display_name": sender_display_name,
-                    "start_timestamp": timestamp,
-                    "messages": [
-                        {
-                            "id": message_id,
-                            "content": message_content,
-                            "sender": {"id": sender_id},
-                            "timestamp": timestamp,
-                            "reaction_counts": {},
-                            "user_reacted_emojis": [],
-                        }
-                    ],
-                }
-                message_group_html = await sync_to_async(render_to_string)(
-                    "chats/partials/_message_group.html", {"group": group}
-                )
-                html = (
-                    f'<div hx-swap-oob="beforeend:#chat-log">{message_group_html}</div>'
-                )
-
-                # If it's the first message, also remove the placeholder
-                channel = await sync_to_async(Channel.objects.get)(id=self.channel_id)
-                message_count = await sync_to_async(channel.channel_messages.count)()
-                if message_count == 1:
-                    html += '<p id="no-messages-p" hx-swap-oob="delete"></p>'
-
-            await self.send(text_data=html)
+            if event["seq"] in self.resumed_seqs:
+                # Already sent while catching up
+                return
+            self.outbound.put(("message", self.protocol.message(event)))
+            # Nobody reacted to a new message yet
+            self._track_reacted_emojis(event["message_id"], set())
+            # Messages shown to a connected member count as read
+            read_positions.report(self.channel_id, self.scope["user"].id, event["seq"])
         except Exception:
             logger.exception("Error in chat_message")
 
@@ -236,28 +499,43 @@ class ChatConsumer(AsyncWebsocketConsumer):
             reaction_counts = event["reaction_counts"]
             current_user_id = self.scope["user"].id
 
-            # Re-fetch reactions for the current user
-            message = await sync_to_async(Message.objects.get)(id=message_id)
-            user_reactions = await sync_to_async(list)(
-                message.message_reactions.filter(reactor=current_user_id).values_list(
-                    "emoji", flat=True
-                )
-            )
-            user_reacted_emojis = set(user_reactions)
-
-            # Render the reactions using a partial template
-            html = await sync_to_async(render_to_string)(
-                "chats/partials/_reactions_list.html",
-                {
-                    "message_id": message_id,
-                    "reaction_counts": reaction_counts,
-                    "user_reacted_emojis": user_reacted_emojis,
-                    "current_user_id": str(current_user_id),
-                },
+            user_reacted_emojis = self.user_reacted_emojis.get(message_id)
+            if user_reacted_emojis is None:
+                # An older message, read once it changes, toggles included
+                user_reacted_emojis = await self._load_reacted_emojis(message_id)
+            else:
+                for toggle in event["toggles"]:
+                    if toggle["reactor_id"] != str(current_user_id):
+                        continue
+                    if toggle["added"]:
+                        user_reacted_emojis.add(toggle["emoji"])
+                    else:
+                        user_reacted_emojis.discard(toggle["emoji"])
+            self._track_reacted_emojis(message_id, user_reacted_emojis)
+
+            # Live updates move the resume cursor too, so reconnects only
+            # replay the changes since the last update received. Updates
+            # from other workers may arrive out of order, it never goes back
+            reaction_seq = None
+            if event["reaction_seq"] > self.reaction_seq:
+                reaction_seq = self.reaction_seq = event["reaction_seq"]
+
+            frame = self.protocol.reactions(
+                message_id,
+                reaction_counts,
+                user_reacted_emojis,
+                str(current_user_id),
+                reaction_seq,
             )
-
-            # Send HTML to WebSocket with OOB swap
-            html = f'<div id="reactions-for-message-{message_id}" hx-swap-oob="outerHTML">{html}</div>'
-            await self.send(text_data=html)
+            # A newer update for the same message supersedes this one
+            self.outbound.put(("reaction", frame), key=("reaction", message_id))
         except Exception:
             logger.exception("Error in reaction_update")
+
+    async def presence_update(self, event):
+        try:
+            frame = self.protocol.presence(event, str(self.scope["user"].id))
+            # Only the latest presence matters
+            self.outbound.put(("presence", frame), key="presence")
+        except Exception:
+            logger.exception("Error in presence_update")
@@ -0,0 +1,120 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.safestring import mark_safe
+
+from chats.metrics import metrics
+from chats.models import ReactionSummary
+
+
+def _digest(*parts):
+    return hashlib.blake2b(repr(parts).encode(), digest_size=12).hexdigest()
+
+
+class FragmentCache:
+    """
+    Caches the rendered HTML of message groups and of their reaction lists.
+    Keys carry the versions of everything the HTML depends on, e.g. the
+    reaction sequence number each reaction toggle stamps on its message, so
+    entries never need to be invalidated: a changed group is simply looked
+    up under a new key. Groups that missed are rendered with the reaction
+    lists that did not change taken from the cache.
+    """
+
+    def __init__(self, cache_alias="default", timeout=60 * 60 * 24):
+        self.cache_alias = cache_alias
+        self.timeout = timeout
+
+    def _reactions_key(self, message):
+        return "chats:fragments:reactions:" + _digest(
+            message.channel_id,
+            message.id,
+            message.reaction_seq,
+            sorted(message.user_reacted_emojis),
+        )
+
+    def _group_key(self, group, timezone_name):
+        return "chats:fragments:group:" + _digest(
+            group["messages"][0].channel_id,
+            group["id"],
+            group["display_name"],
+            str(group["avatar"]),
+            timezone_name,
+            [
+                (message.id, message.reaction_seq, sorted(message.user_reacted_emojis))
+                for message in group["messages"]
+            ],
+        )
+
+    def render(self, groups):
+        """
+        Sets the `html` of each group, rendering only the groups and reaction
+        lists that are not cached. Messages need their `user_reacted_emojis`,
+        the reaction counts are only loaded for the groups rendered.
+        """
+        cache = caches[self.cache_alias]
+        timezone_name = timezone.get_current_timezone_name()
+        keys = {self._group_key(group, timezone_name): group for group in groups}
+        cached = cache.get_many(keys)
+        missed = [(key, group) for key, group in keys.items() if key not in cached]
+        metrics.incr("fragments.groups.hits", len(cached))
+        metrics.incr("fragments.groups.misses", len(missed))
+
+        for key, html in cached.items():
+            keys[key]["html"] = mark_safe(html)
+        if not missed:
+            return
+
+        messages = [message for _, group in missed for message in group["messages"]]
+        self._render_reactions(messages)
+        rendered = {}
+        for key, group in missed:
+            html = render_to_string(
+                "chats/partials/_message_group.html", {"group": group}
+            )
+            group["html"] = mark_safe(html)
+            rendered[key] = html
+        cache.set_many(rendered, self.timeout)
+
+    def _render_reactions(self, messages):
+        """Sets the `reactions_html` of messages, from the cache when possible."""
+        cache = caches[self.cache_alias]
+        keys = {self._reactions_key(message): message for message in messages}
+        cached = cache.get_many(keys)
+        metrics.incr("fragments.reactions.hits", len(cached))
+        metrics.incr("fragments.reactions.misses", len(keys) - len(cached))
+
+        missed = [message for key, message in keys.items() if key not in cached]
+        reaction_counts = ReactionSummary.counts_for([message.id for message in missed])
+        rendered = {}
+        for key, message in keys.items():
+            if key in cached:
+                message.reactions_html = mark_safe(cached[key])
+                continue
+            message.reaction_counts = reaction_counts.get(message.id, {})
+            html = render_to_string(
+                "chats/partials/_reactions_list.html",
+                {
+                    "message_id": message.id,
+                    "reaction_counts": message.reaction_counts,
+                    "user_reacted_emojis": message.user_reacted_emojis,
+                },
+            )
+            message.reactions_html = mark_safe(html)
+            rendered[key] = html
+        cache.set_many(rendered, self.timeout)
+
+    def hit_ratio(self, kind="groups"):
+        """Share of the `groups` or `reactions` lookups served from the cache."""
+        hits = metrics.get(f"fragments.{kind}.hits")
+        lookups = hits + metrics.get(f"fragments.{kind}.misses")
+        return hits / lookups if lookups else 0.0
+
+
+fragment_cache = FragmentCache(
+    cache_alias=getattr(settings, "CHAT_FRAGMENT_CACHE", "default"),
+    timeout=getattr(settings, "CHAT_FRAGMENT_CACHE_TIMEOUT", 60 * 60 * 24),
+)
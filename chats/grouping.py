@@ -0,0 +1,107 @@
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+
+# Messages from the same sender within this window share a group
+GROUPING_WINDOW = timedelta(minutes=5)
+
+
+def sender_key(message):
+    return str(message.sender_id) if message.sender_id else None
+
+
+@dataclass
+class GroupTail:
+    """
+    The last message of a channel and the group it belongs to, with the
+    sequence number of the message to tell whether the tail is current.
+    """
+
+    sender_id: str | None
+    timestamp: datetime
+    group_id: int
+    seq: int | None = None
+
+    def continues(self, sender_id, timestamp):
+        """Whether a message from `sender_id` at `timestamp` joins this group."""
+        return (
+            self.sender_id == sender_id and timestamp - self.timestamp < GROUPING_WINDOW
+        )
+
+    def to_dict(self):
+        return {
+            "sender_id": self.sender_id,
+            "timestamp": self.timestamp.isoformat(),
+            "group_id": self.group_id,
+            "seq": self.seq,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            sender_id=data["sender_id"],
+            timestamp=datetime.fromisoformat(data["timestamp"]),
+            group_id=data["group_id"],
+            seq=data.get("seq"),
+        )
+
+
+class MessageGrouper:
+    """
+    Groups a stream of messages: a message joins the group of the message
+    before it when both have the same sender and are less than
+    GROUPING_WINDOW apart. Only the tail of the last group is kept between
+    messages, so a grouper started from a stored tail continues its group.
+
+    With `reverse` the messages come newest first, e.g. when paging back
+    through history, and the group id of the tail is the oldest message
+    seen so far.
+    """
+
+    def __init__(self, tail=None, reverse=False):
+        self.tail = tail
+        self.reverse = reverse
+
+    def add(self, message):
+        """
+        Moves the tail to `message` and returns whether the message joins
+        the group of the previous one, and its group id.
+        """
+        sender_id = sender_key(message)
+        tail = self.tail
+        if self.reverse:
+            joins = (
+                tail is not None
+                and tail.sender_id == sender_id
+                and tail.timestamp - message.timestamp < GROUPING_WINDOW
+            )
+            group_id = message.id
+        else:
+            joins = tail is not None and tail.continues(sender_id, message.timestamp)
+            group_id = tail.group_id if joins else message.id
+
+        self.tail = GroupTail(sender_id, message.timestamp, group_id, message.seq)
+        return joins, group_id
+
+    def groups(self, messages):
+        """
+        Yields the groups of `messages` as (group id, messages) pairs, the
+        messages of each group oldest first. `messages` is read lazily and
+        only the group being built is held in memory, so a group is yielded
+        once the first message after it has been read.
+        """
+        group = []
+        group_id = None
+        for message in messages:
+            joins, message_group_id = self.add(message)
+            if group and not joins:
+                yield self._finish(group_id, group)
+                group = []
+            group.append(message)
+            group_id = message_group_id
+        if group:
+            yield self._finish(group_id, group)
+
+    def _finish(self, group_id, group):
+        if self.reverse:
+            group.reverse()
+        return group_id, group
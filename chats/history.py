@@ -0,0 +1,107 @@
+from itertools import islice
+
+from django.conf import settings
+from django.db.models import Q
+
+from chats.fragments import fragment_cache
+from chats.grouping import MessageGrouper
+from chats.models import Reaction
+
+
+def _older_messages(channel, before, chunk_size):
+    """
+    Streams the messages of `channel` older than the `(timestamp, id)`
+    keyset `before`, newest first, fetched in chunks.
+    """
+    messages = channel.channel_messages.select_related("sender__profile").order_by(
+        "-timestamp", "-id"
+    )
+    if before is not None:
+        timestamp, message_id = before
+        messages = messages.filter(
+            Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=message_id)
+        )
+    return messages.iterator(chunk_size=chunk_size)
+
+
+def newer_keyset(channel, message, newer=None):
+    """
+    Returns the `(timestamp, id)` keyset of the history page that ends
+    `newer` messages after `message`, or None when the latest page shows
+    them, so a chat can be opened at a message with some context after it.
+    """
+    newer = newer or getattr(settings, "CHAT_SEARCH_CONTEXT_MESSAGES", 10)
+    return (
+        channel.channel_messages.filter(
+            Q(timestamp__gt=message.timestamp)
+            | Q(timestamp=message.timestamp, id__gt=message.id)
+        )
+        .order_by("timestamp", "id")
+        .values_list("timestamp", "id")[newer : newer + 1]
+        .first()
+    )
+
+
+def _message_group(group_id, messages):
+    first = messages[0]
+    sender = first.sender
+    return {
+        "id": group_id,
+        "sender": sender,
+        "avatar": (
+            sender.profile.profile_picture
+            if hasattr(sender, "profile") and sender.profile.profile_picture
+            else "/static/images/default_avatar.png"
+        ),
+        "display_name": (
+            sender.profile.display_name
+            if hasattr(sender, "profile")
+            else sender.username
+        ),
+        "messages": messages,
+        "start_timestamp": first.timestamp,
+        "last_timestamp": messages[-1].timestamp,
+    }
+
+
+def history_page(channel, user, before=None, size=None):
+    """
+    Returns up to `size` message groups of `channel` older than the
+    `(timestamp, id)` keyset `before`, oldest first and with their rendered
+    `html`, and the keyset of the page before them, or None when they start
+    the channel.
+
+    Groups are read backwards from the newest message, streamed in chunks,
+    and a page only ends on a message that does not join the group after
+    it, so groups are never split across pages.
+    """
+    size = size or getattr(settings, "CHAT_HISTORY_PAGE_GROUPS", 50)
+    chunk_size = getattr(settings, "CHAT_HISTORY_CHUNK_SIZE", 200)
+
+    grouper = MessageGrouper(reverse=True)
+    stream = grouper.groups(_older_messages(channel, before, chunk_size))
+    groups = list(islice(stream, size))
+    stream.close()
+
+    next_page = None
+    if groups:
+        oldest = groups[-1][1][0]
+        # Groups are yielded once the message before them is read, so the
+        # grouper is past the last group when there is older history
+        if grouper.tail.group_id != oldest.id:
+            next_page = (oldest.timestamp, oldest.id)
+
+    messages = [message for _, group in groups for message in group]
+    user_reacted_emojis = Reaction.emojis_by(
+        user.id, [message.id for message in messages]
+    )
+    for message in messages:
+        message.user_reacted_emojis = user_reacted_emojis.get(message.id, set())
+
+    grouped_messages = [
+        _message_group(group_id, group) for group_id, group in reversed(groups)
+    ]
+    # Unchanged groups come from the cache, the reaction counts are only read
+    # for the groups rendered
+    fragment_cache.render(grouped_messages)
+    return grouped_messages, next_page
@@ -0,0 +1,110 @@
+import random
+import time
+import tracemalloc
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chats.grouping import GROUPING_WINDOW, MessageGrouper
+from chats.models import Message
+
+
+def group_eagerly(messages):
+    """
+    Groups the way the chat view used to: every message is loaded first and
+    every group is kept as a dict until the page is rendered.
+    """
+    grouped_messages = []
+    current_group = None
+    for message in list(messages):
+        if (
+            current_group
+            and current_group["sender_id"] == message.sender_id
+            and message.timestamp - current_group["last_timestamp"] < GROUPING_WINDOW
+        ):
+            current_group["messages"].append(message)
+            current_group["last_timestamp"] = message.timestamp
+        else:
+            if current_group:
+                grouped_messages.append(current_group)
+            current_group = {
+                "id": message.id,
+                "sender_id": message.sender_id,
+                "messages": [message],
+                "last_timestamp": message.timestamp,
+            }
+    if current_group:
+        grouped_messages.append(current_group)
+    return len(grouped_messages)
+
+
+def group_streaming(messages):
+    """Streams the messages through the grouping engine."""
+    return sum(1 for _ in MessageGrouper().groups(messages))
+
+
+STRATEGIES = {"eager": group_eagerly, "streaming": group_streaming}
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares the time and peak memory of grouping a channel's messages "
+        "eagerly and with the streaming grouping engine. Messages are "
+        "generated in memory unless --channel names a channel to read."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=1_000_000)
+        parser.add_argument("--senders", type=int, default=5)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--channel", help="Group the messages of this channel instead."
+        )
+        parser.add_argument("--chunk-size", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            f"{'strategy':<12}{'groups':>10}{'seconds':>10}{'peak KB':>10}"
+        )
+        for name, strategy in STRATEGIES.items():
+            started = time.perf_counter()
+            groups = strategy(self.messages(options))
+            elapsed = time.perf_counter() - started
+
+            # Tracing allocations slows everything down, measure separately
+            tracemalloc.start()
+            strategy(self.messages(options))
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            self.stdout.write(
+                f"{name:<12}{groups:>10}{elapsed:>10.2f}{peak / 1024:>10.0f}"
+            )
+
+    def messages(self, options):
+        if options["channel"]:
+            return (
+                Message.objects.filter(channel_id=options["channel"])
+                .order_by("timestamp", "id")
+                .only("id", "sender_id", "timestamp", "seq", "content")
+                .iterator(chunk_size=options["chunk_size"])
+            )
+        return self.generate(options)
+
+    def generate(self, options):
+        # Bursts of messages from the same sender with gaps of up to a few
+        # minutes, so groups of a few messages on average
+        rng = random.Random(options["seed"])
+        timestamp = timezone.now()
+        sender_id = 1
+        for i in range(options["messages"]):
+            if rng.random() < 0.3:
+                sender_id = rng.randint(1, options["senders"])
+            timestamp += timedelta(seconds=rng.randint(1, 400))
+            yield Message(
+                id=i + 1,
+                sender_id=sender_id,
+                content="hello there",
+                timestamp=timestamp,
+            )
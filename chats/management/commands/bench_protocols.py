@@ -0,0 +1,131 @@
+import random
+import time
+import uuid
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chats.compression import FrameSizes
+from chats.consumers import ChatConsumer
+from chats.grouping import MessageGrouper
+from chats.models import Message
+from chats.protocol import PROTOCOLS
+
+UserModel = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        "Compares the bytes and server CPU time per chat message of the HTMX "
+        "and JSON wire protocols. Nothing is written to the database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=2000)
+        parser.add_argument(
+            "--recipients",
+            type=int,
+            default=10,
+            help="Connections receiving each message.",
+        )
+        parser.add_argument("--senders", type=int, default=3)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        channel_id = uuid.uuid4()
+        consumers = []
+        for i in range(options["senders"]):
+            consumer = ChatConsumer()
+            consumer.scope = {"user": UserModel(username=f"bench{i}")}
+            consumer.channel_id = str(channel_id)
+            consumer._user_profile_data = {
+                "display_name": f"Bench User {i}",
+                "profile_picture": "/static/images/default_avatar.png",
+            }
+            consumers.append(consumer)
+
+        # Bursts of messages from the same sender, so both new groups and
+        # continued groups are measured
+        messages = []
+        timestamp = timezone.now()
+        consumer = consumers[0]
+        for i in range(options["messages"]):
+            if rng.random() < 0.3:
+                consumer = rng.choice(consumers)
+            timestamp += timedelta(seconds=rng.randint(1, 90))
+            message = Message(
+                id=i + 1,
+                channel_id=channel_id,
+                sender=consumer.scope["user"],
+                content=" ".join(
+                    rng.choice(["hello", "there", "how", "is", "it", "going", "ok"])
+                    for _ in range(rng.randint(2, 15))
+                ),
+                timestamp=timestamp,
+            )
+            messages.append((consumer, message))
+
+        results = {
+            name: self.run(protocol, messages, options)
+            for name, protocol in PROTOCOLS.items()
+        }
+
+        count = options["messages"]
+        self.stdout.write(
+            f"{count} messages, {options['recipients']} recipients per message"
+        )
+        self.stdout.write(
+            f"{'protocol':<10}{'bytes/msg':>12}{'deflate':>10}"
+            f"{'no takeover':>13}{'cpu us/msg':>12}"
+        )
+        for name, (sizes, cpu) in results.items():
+            raw, compressed, uncontexted = (size / count for size in sizes)
+            self.stdout.write(
+                f"{name:<10}{raw:>12.1f}{compressed:>10.1f}"
+                f"{uncontexted:>13.1f}{cpu / count * 1e6:>12.1f}"
+            )
+
+    def run(self, protocol, messages, options):
+        """
+        Builds the frames of every message the way the consumer does: the
+        sender prepares one event and each recipient frames it. Returns the
+        raw and compressed (with and without context takeover) bytes sent to
+        one recipient, and the CPU time for all recipients.
+        """
+        frames = []
+        grouper = MessageGrouper()
+        started = time.process_time()
+        for consumer, message in messages:
+            should_group, group_id = grouper.add(message)
+
+            event = {
+                "should_group": should_group,
+                "group_id": group_id,
+                "is_first_message": False,
+            }
+            if protocol.name == "htmx":
+                event["html"] = consumer._render_message(
+                    message, should_group, group_id
+                )
+            else:
+                event["message"] = consumer._message_data(message)
+
+            for _ in range(options["recipients"]):
+                frame = protocol.message(event)
+            frames.append(frame)
+        cpu = time.process_time() - started
+
+        # Compression happens in the server, outside of the measured time
+        sizes = [0, 0, 0]
+        takeover = FrameSizes(context_takeover=True)
+        no_takeover = FrameSizes(context_takeover=False)
+        for frame in frames:
+            raw, compressed = takeover.record("bench", frame)
+            _, uncontexted = no_takeover.record("bench", frame)
+            sizes[0] += raw
+            sizes[1] += compressed
+            sizes[2] += uncontexted
+        return sizes, cpu
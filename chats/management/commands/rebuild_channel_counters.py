@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from chats.models import Channel
+
+
+class Command(BaseCommand):
+    help = "Recomputes the denormalized message and member counters of channels."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "channel_ids",
+            nargs="*",
+            help="Only rebuild these channels (defaults to all channels).",
+        )
+
+    def handle(self, *args, **options):
+        channels = Channel.objects.all()
+        if options["channel_ids"]:
+            channels = channels.filter(id__in=options["channel_ids"])
+
+        updated = Channel.rebuild_counters(channels)
+        self.stdout.write(
+            self.style.SUCCESS(f"Rebuilt counters for {updated} channels")
+        )
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from chats.search import reindex_messages
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the full-text search index of all messages in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Number of messages indexed per transaction (default 1000).",
+        )
+
+    def handle(self, *args, **options):
+        indexed = 0
+        for indexed in reindex_messages(options["batch_size"]):
+            if options["verbosity"] > 1:
+                self.stdout.write(f"Indexed {indexed} messages")
+
+        self.stdout.write(self.style.SUCCESS(f"Indexed {indexed} messages"))
@@ -0,0 +1,38 @@
+import threading
+from collections import Counter
+
+
+class Metrics:
+    """
+    Process-local counters and high-water marks for the chat hot paths.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = Counter()
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def max(self, name, value):
+        """Keeps the highest value seen for `name`."""
+        with self._lock:
+            if value > self._counters[name]:
+                self._counters[name] = value
+
+    def get(self, name):
+        with self._lock:
+            return self._counters[name]
+
+    def snapshot(self):
+        """Returns a copy of all counters."""
+        with self._lock:
+            return dict(self._counters)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+
+
+metrics = Metrics()
@@ -0,0 +1,51 @@
+# Generated by Django 5.2.5 on 2026-10-18 01:18
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def populate_counters(apps, schema_editor):
+    Channel = apps.get_model('chats', 'Channel')
+    Message = apps.get_model('chats', 'Message')
+    Membership = Channel.members.through
+
+    message_counts = (
+        Message.objects.filter(channel=OuterRef('pk'))
+        .order_by()
+        .values('channel')
+        .annotate(count=Count('pk'))
+        .values('count')
+    )
+    member_counts = (
+        Membership.objects.filter(channel=OuterRef('pk'))
+        .order_by()
+        .values('channel')
+        .annotate(count=Count('pk'))
+        .values('count')
+    )
+    Channel.objects.update(
+        message_count=Coalesce(Subquery(message_counts), 0),
+        member_count=Coalesce(Subquery(member_counts), 0),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='channel',
+            name='member_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='channel',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(populate_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,112 @@
+# Generated by Django 5.2.5 on 2026-10-18 01:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+SQLITE_TRIGGERS = [
+    """
+    CREATE TRIGGER chats_reaction_summary_insert AFTER INSERT ON chats_reaction
+    BEGIN
+        INSERT INTO chats_reactionsummary (message_id, emoji, count)
+        VALUES (NEW.message_id, NEW.emoji, 1)
+        ON CONFLICT (message_id, emoji) DO UPDATE SET count = count + 1;
+    END
+    """,
+    """
+    CREATE TRIGGER chats_reaction_summary_delete AFTER DELETE ON chats_reaction
+    BEGIN
+        UPDATE chats_reactionsummary SET count = count - 1
+        WHERE message_id = OLD.message_id AND emoji = OLD.emoji;
+        DELETE FROM chats_reactionsummary
+        WHERE message_id = OLD.message_id AND emoji = OLD.emoji AND count <= 0;
+    END
+    """,
+]
+
+POSTGRESQL_TRIGGERS = [
+    """
+    CREATE OR REPLACE FUNCTION chats_reaction_summary_update() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO chats_reactionsummary (message_id, emoji, count)
+            VALUES (NEW.message_id, NEW.emoji, 1)
+            ON CONFLICT (message_id, emoji)
+            DO UPDATE SET count = chats_reactionsummary.count + 1;
+            RETURN NEW;
+        END IF;
+        UPDATE chats_reactionsummary SET count = count - 1
+        WHERE message_id = OLD.message_id AND emoji = OLD.emoji;
+        DELETE FROM chats_reactionsummary
+        WHERE message_id = OLD.message_id AND emoji = OLD.emoji AND count <= 0;
+        RETURN OLD;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE TRIGGER chats_reaction_summary_update
+    AFTER INSERT OR DELETE ON chats_reaction
+    FOR EACH ROW EXECUTE FUNCTION chats_reaction_summary_update()
+    """,
+]
+
+DROP_TRIGGERS = {
+    'sqlite': [
+        'DROP TRIGGER IF EXISTS chats_reaction_summary_insert',
+        'DROP TRIGGER IF EXISTS chats_reaction_summary_delete',
+    ],
+    'postgresql': [
+        'DROP TRIGGER IF EXISTS chats_reaction_summary_update ON chats_reaction',
+        'DROP FUNCTION IF EXISTS chats_reaction_summary_update()',
+    ],
+}
+
+
+def create_triggers(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        statements = SQLITE_TRIGGERS
+    elif vendor == 'postgresql':
+        statements = POSTGRESQL_TRIGGERS
+    else:
+        raise NotImplementedError(f'Reaction summary triggers are not available for {vendor}')
+    for statement in statements:
+        schema_editor.execute(statement)
+
+
+def drop_triggers(apps, schema_editor):
+    for statement in DROP_TRIGGERS.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(statement)
+
+
+def populate_summaries(apps, schema_editor):
+    schema_editor.execute(
+        """
+        INSERT INTO chats_reactionsummary (message_id, emoji, count)
+        SELECT message_id, emoji, COUNT(*) FROM chats_reaction
+        GROUP BY message_id, emoji
+        """
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0002_channel_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReactionSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('emoji', models.CharField(max_length=50)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reaction_summaries', to='chats.message')),
+            ],
+            options={
+                'unique_together': {('message', 'emoji')},
+            },
+        ),
+        migrations.RunPython(populate_summaries, migrations.RunPython.noop),
+        migrations.RunPython(create_triggers, drop_triggers),
+    ]
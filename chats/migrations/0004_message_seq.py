@@ -0,0 +1,155 @@
+# Generated by Django 5.2.5 on 2026-10-18 01:53
+
+from importlib import import_module
+
+from django.db import migrations, models
+
+reactionsummary = import_module('chats.migrations.0003_reactionsummary')
+
+# The reaction summary triggers, which now also stamp each reaction change
+# with the next reaction sequence number of the channel
+SQLITE_TRIGGERS = [
+    """
+    CREATE TRIGGER chats_reaction_summary_insert AFTER INSERT ON chats_reaction
+    BEGIN
+        INSERT INTO chats_reactionsummary (message_id, emoji, count)
+        VALUES (NEW.message_id, NEW.emoji, 1)
+        ON CONFLICT (message_id, emoji) DO UPDATE SET count = count + 1;
+        UPDATE chats_channel SET reaction_seq = reaction_seq + 1
+        WHERE id = (SELECT channel_id FROM chats_message WHERE id = NEW.message_id);
+        UPDATE chats_message SET reaction_seq = (
+            SELECT reaction_seq FROM chats_channel WHERE id = chats_message.channel_id
+        )
+        WHERE id = NEW.message_id;
+    END
+    """,
+    """
+    CREATE TRIGGER chats_reaction_summary_delete AFTER DELETE ON chats_reaction
+    BEGIN
+        UPDATE chats_reactionsummary SET count = count - 1
+        WHERE message_id = OLD.message_id AND emoji = OLD.emoji;
+        DELETE FROM chats_reactionsummary
+        WHERE message_id = OLD.message_id AND emoji = OLD.emoji AND count <= 0;
+        UPDATE chats_channel SET reaction_seq = reaction_seq + 1
+        WHERE id = (SELECT channel_id FROM chats_message WHERE id = OLD.message_id);
+        UPDATE chats_message SET reaction_seq = (
+            SELECT reaction_seq FROM chats_channel WHERE id = chats_message.channel_id
+        )
+        WHERE id = OLD.message_id;
+    END
+    """,
+]
+
+POSTGRESQL_TRIGGERS = [
+    """
+    CREATE OR REPLACE FUNCTION chats_reaction_summary_update() RETURNS trigger AS $$
+    DECLARE
+        changed_message_id bigint;
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            changed_message_id := NEW.message_id;
+            INSERT INTO chats_reactionsummary (message_id, emoji, count)
+            VALUES (NEW.message_id, NEW.emoji, 1)
+            ON CONFLICT (message_id, emoji)
+            DO UPDATE SET count = chats_reactionsummary.count + 1;
+        ELSE
+            changed_message_id := OLD.message_id;
+            UPDATE chats_reactionsummary SET count = count - 1
+            WHERE message_id = OLD.message_id AND emoji = OLD.emoji;
+            DELETE FROM chats_reactionsummary
+            WHERE message_id = OLD.message_id AND emoji = OLD.emoji AND count <= 0;
+        END IF;
+        WITH bumped AS (
+            UPDATE chats_channel SET reaction_seq = reaction_seq + 1
+            WHERE id = (SELECT channel_id FROM chats_message WHERE id = changed_message_id)
+            RETURNING reaction_seq
+        )
+        UPDATE chats_message SET reaction_seq = (SELECT reaction_seq FROM bumped)
+        WHERE id = changed_message_id;
+        IF TG_OP = 'INSERT' THEN
+            RETURN NEW;
+        END IF;
+        RETURN OLD;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE TRIGGER chats_reaction_summary_update
+    AFTER INSERT OR DELETE ON chats_reaction
+    FOR EACH ROW EXECUTE FUNCTION chats_reaction_summary_update()
+    """,
+]
+
+
+def run_vendor_statements(schema_editor, statements_by_vendor):
+    vendor = schema_editor.connection.vendor
+    if vendor not in statements_by_vendor:
+        raise NotImplementedError(f'Reaction summary triggers are not available for {vendor}')
+    for statement in statements_by_vendor[vendor]:
+        schema_editor.execute(statement)
+
+
+def create_triggers(apps, schema_editor):
+    reactionsummary.drop_triggers(apps, schema_editor)
+    run_vendor_statements(schema_editor, {'sqlite': SQLITE_TRIGGERS, 'postgresql': POSTGRESQL_TRIGGERS})
+
+
+def restore_triggers(apps, schema_editor):
+    reactionsummary.drop_triggers(apps, schema_editor)
+    reactionsummary.create_triggers(apps, schema_editor)
+
+
+def populate_seqs(apps, schema_editor):
+    Channel = apps.get_model('chats', 'Channel')
+    Message = apps.get_model('chats', 'Message')
+    for channel in Channel.objects.only('id').iterator():
+        messages = list(Message.objects.filter(channel=channel).order_by('timestamp', 'id').only('id'))
+        for seq, message in enumerate(messages, start=1):
+            message.seq = seq
+        Message.objects.bulk_update(messages, ['seq'], batch_size=1000)
+        Channel.objects.filter(pk=channel.pk).update(last_seq=len(messages))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0003_reactionsummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='channel',
+            name='last_seq',
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='channel',
+            name='reaction_seq',
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='reaction_seq',
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveBigIntegerField(editable=False, null=True),
+        ),
+        migrations.RunPython(populate_seqs, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveBigIntegerField(editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['channel', 'reaction_seq'], name='chats_message_reaction_seq'),
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('channel', 'seq'), name='chats_message_channel_seq'),
+        ),
+        migrations.RunPython(create_triggers, restore_triggers),
+    ]
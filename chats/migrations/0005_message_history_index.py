@@ -0,0 +1,17 @@
+# Generated by Django 5.2.5 on 2026-10-18 02:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0004_message_seq'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['channel', 'timestamp', 'id'], name='chats_message_history'),
+        ),
+    ]
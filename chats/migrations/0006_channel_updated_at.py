@@ -0,0 +1,35 @@
+# Generated by Django 5.2.5 on 2026-10-18 02:16
+
+from importlib import import_module
+
+from django.db import migrations, models
+
+reactionsummary = import_module('chats.migrations.0003_reactionsummary')
+message_seq = import_module('chats.migrations.0004_message_seq')
+
+
+# SQLite rebuilds the channel table to add the column, which the reaction
+# triggers refer to, so they are dropped meanwhile
+def drop_triggers(apps, schema_editor):
+    reactionsummary.drop_triggers(apps, schema_editor)
+
+
+def create_triggers(apps, schema_editor):
+    message_seq.create_triggers(apps, schema_editor)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0005_message_history_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_triggers, create_triggers),
+        migrations.AddField(
+            model_name='channel',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.RunPython(create_triggers, drop_triggers),
+    ]
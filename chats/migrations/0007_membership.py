@@ -0,0 +1,60 @@
+# Generated by Django 5.2.5 on 2026-10-18 02:21
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def mark_existing_members_read(apps, schema_editor):
+    Channel = apps.get_model('chats', 'Channel')
+    Membership = apps.get_model('chats', 'Membership')
+    Membership.objects.update(
+        last_read_seq=Subquery(Channel.objects.filter(pk=OuterRef('channel_id')).values('last_seq')[:1])
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0006_channel_updated_at'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        # The implicit many-to-many table becomes the membership table as is
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='Membership',
+                    fields=[
+                        ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                        ('channel', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='chats.channel')),
+                        ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to=settings.AUTH_USER_MODEL)),
+                    ],
+                    options={
+                        'db_table': 'chats_channel_members',
+                        'unique_together': {('channel', 'user')},
+                    },
+                ),
+                migrations.AlterField(
+                    model_name='channel',
+                    name='members',
+                    field=models.ManyToManyField(related_name='member_of', through='chats.Membership', to=settings.AUTH_USER_MODEL),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name='membership',
+            name='joined_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='membership',
+            name='last_read_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        # Existing members start with nothing unread
+        migrations.RunPython(mark_existing_members_read, migrations.RunPython.noop),
+    ]
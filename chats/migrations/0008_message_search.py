@@ -0,0 +1,100 @@
+# Generated by Django 5.2.5 on 2026-10-18 09:12
+
+from django.db import migrations
+
+# An FTS5 index over the message contents, reading the contents from the
+# message table itself, kept in sync by triggers. Reaction updates of messages
+# leave the index alone
+SQLITE_INDEX = [
+    """
+    CREATE VIRTUAL TABLE chats_message_fts USING fts5(
+        content, content='chats_message', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER chats_message_fts_insert AFTER INSERT ON chats_message
+    BEGIN
+        INSERT INTO chats_message_fts (rowid, content) VALUES (NEW.id, NEW.content);
+    END
+    """,
+    """
+    CREATE TRIGGER chats_message_fts_delete AFTER DELETE ON chats_message
+    BEGIN
+        INSERT INTO chats_message_fts (chats_message_fts, rowid, content)
+        VALUES ('delete', OLD.id, OLD.content);
+    END
+    """,
+    """
+    CREATE TRIGGER chats_message_fts_update AFTER UPDATE OF content ON chats_message
+    BEGIN
+        INSERT INTO chats_message_fts (chats_message_fts, rowid, content)
+        VALUES ('delete', OLD.id, OLD.content);
+        INSERT INTO chats_message_fts (rowid, content) VALUES (NEW.id, NEW.content);
+    END
+    """,
+    "INSERT INTO chats_message_fts (chats_message_fts) VALUES ('rebuild')",
+]
+
+# A tsvector column with a GIN index, set by a trigger whenever the content is
+# written. Existing messages are indexed by the reindex_messages command
+POSTGRESQL_INDEX = [
+    'ALTER TABLE chats_message ADD COLUMN search_vector tsvector',
+    'CREATE INDEX chats_message_search ON chats_message USING GIN (search_vector)',
+    """
+    CREATE OR REPLACE FUNCTION chats_message_search_update() RETURNS trigger AS $$
+    BEGIN
+        NEW.search_vector := to_tsvector('simple', NEW.content);
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE TRIGGER chats_message_search_update
+    BEFORE INSERT OR UPDATE OF content ON chats_message
+    FOR EACH ROW EXECUTE FUNCTION chats_message_search_update()
+    """,
+]
+
+DROP_INDEX = {
+    'sqlite': [
+        'DROP TRIGGER IF EXISTS chats_message_fts_insert',
+        'DROP TRIGGER IF EXISTS chats_message_fts_delete',
+        'DROP TRIGGER IF EXISTS chats_message_fts_update',
+        'DROP TABLE IF EXISTS chats_message_fts',
+    ],
+    'postgresql': [
+        'DROP TRIGGER IF EXISTS chats_message_search_update ON chats_message',
+        'DROP FUNCTION IF EXISTS chats_message_search_update()',
+        'DROP INDEX IF EXISTS chats_message_search',
+        'ALTER TABLE chats_message DROP COLUMN IF EXISTS search_vector',
+    ],
+}
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        statements = SQLITE_INDEX
+    elif vendor == 'postgresql':
+        statements = POSTGRESQL_INDEX
+    else:
+        raise NotImplementedError(f'Message search is not available for {vendor}')
+    for statement in statements:
+        schema_editor.execute(statement)
+
+
+def drop_search_index(apps, schema_editor):
+    for statement in DROP_INDEX.get(schema_editor.connection.vendor, []):
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0007_membership'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -1,11 +1,30 @@
 import uuid
 
 from django.contrib.auth import get_user_model
-from django.db import models
-from django.urls import reverse_lazy
+from django.core.cache import cache
+from django.db import connection, models
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
+from django.urls import reverse, reverse_lazy
+from django.utils import timezone
 
 UserModel = get_user_model()
 
+MEMBERSHIP_CACHE_TIMEOUT = 60 * 10
+
+
+def membership_cache_key(channel_id, user_id):
+    return f"chats:member:{channel_id}:{user_id}"
+
+
+SIDEBAR_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def sidebar_cache_key(user_id):
+    return f"chats:sidebar:{user_id}"
+
 
 class Channel(models.Model):
     """
@@ -19,7 +38,18 @@ class Channel(models.Model):
         to=UserModel, on_delete=models.CASCADE, related_name="created_channels"
     )
     invite_code = models.UUIDField(default=uuid.uuid4, unique=True, editable=True)
-    members = models.ManyToManyField(to=UserModel, related_name="member_of")
+    members = models.ManyToManyField(
+        to=UserModel, related_name="member_of", through="Membership"
+    )
+    # Denormalized counters, kept in sync by the signal handlers below
+    message_count = models.PositiveIntegerField(default=0, editable=False)
+    member_count = models.PositiveIntegerField(default=0, editable=False)
+    # Sequence numbers of the latest message and reaction change, so clients
+    # can resume from where they left off
+    last_seq = models.PositiveBigIntegerField(default=0, editable=False)
+    reaction_seq = models.PositiveBigIntegerField(default=0, editable=False)
+    # Changes on every save, e.g. renames, but not on counter updates
+    updated_at = models.DateTimeField(auto_now=True)
 
     def save(self, *args, **kwargs):
         """
@@ -30,6 +60,53 @@ class Channel(models.Model):
         if is_new:
             self.members.add(self.owner)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # The stored name, so saves only drop cached sidebars on renames
+        if "name" in field_names:
+            instance._saved_name = instance.name
+        return instance
+
+    @staticmethod
+    def is_member(channel_id, user_id):
+        """
+        Checks whether a user belongs to a channel with an indexed lookup,
+        cached until the membership changes.
+        """
+        key = membership_cache_key(channel_id, user_id)
+        is_member = cache.get(key)
+        if is_member is None:
+            is_member = Channel.members.through.objects.filter(
+                channel_id=channel_id, user_id=user_id
+            ).exists()
+            cache.set(key, is_member, MEMBERSHIP_CACHE_TIMEOUT)
+        return is_member
+
+    @staticmethod
+    def reserve_seq(channel_id, count=1):
+        """
+        Counts `count` new messages of a channel and returns the sequence
+        number of the last one and the new message count. Done in a single
+        statement, so concurrent writers never share a number.
+        """
+        table = connection.ops.quote_name(Channel._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"UPDATE {table} SET last_seq = last_seq + %s, "
+                "message_count = message_count + %s WHERE id = %s "
+                "RETURNING last_seq, message_count",
+                [
+                    count,
+                    count,
+                    Channel._meta.pk.get_db_prep_value(channel_id, connection),
+                ],
+            )
+            row = cursor.fetchone()
+        if row is None:
+            raise Channel.DoesNotExist(f"Channel {channel_id} does not exist")
+        return row[0], row[1]
+
     def get_invite_link(self):
         """Constructs the full URL of for joining a channel."""
         return reverse_lazy(
@@ -47,12 +124,90 @@ class Channel(models.Model):
     def __str__(self):
         return f"Channel: '{self.name}' owned by User: '{self.owner}'"
 
+    @classmethod
+    def rebuild_counters(cls, queryset=None):
+        """
+        Recomputes the message and member counters from the related tables.
+        Returns the number of updated channels.
+        """
+        if queryset is None:
+            queryset = cls.objects.all()
+
+        message_counts = (
+            Message.objects.filter(channel=OuterRef("pk"))
+            .order_by()
+            .values("channel")
+            .annotate(count=Count("pk"))
+            .values("count")
+        )
+        member_counts = (
+            cls.members.through.objects.filter(channel=OuterRef("pk"))
+            .order_by()
+            .values("channel")
+            .annotate(count=Count("pk"))
+            .values("count")
+        )
+        return queryset.update(
+            message_count=Coalesce(Subquery(message_counts), 0),
+            member_count=Coalesce(Subquery(member_counts), 0),
+        )
+
+
+class Membership(models.Model):
+    """
+    Represents a user's membership of a channel and their state in it.
+    """
+
+    class Meta:
+        # The table of the implicit many-to-many model it replaced
+        db_table = "chats_channel_members"
+        unique_together = ("channel", "user")
+
+    channel = models.ForeignKey(
+        to=Channel, on_delete=models.CASCADE, related_name="memberships"
+    )
+    user = models.ForeignKey(
+        to=UserModel, on_delete=models.CASCADE, related_name="memberships"
+    )
+    joined_at = models.DateTimeField(default=timezone.now)
+    # Sequence number of the last message the member has read
+    last_read_seq = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return f"Membership: User '{self.user}' in Channel: '{self.channel}'"
+
+    def unread_messages(self):
+        """
+        Returns the messages sent since the member last read the channel,
+        looked up through the (channel, seq) index.
+        """
+        return Message.objects.filter(
+            channel_id=self.channel_id, seq__gt=self.last_read_seq
+        )
+
 
 class Message(models.Model):
     """
-    Represents a message in a channel
+    Represents a message in a channel. The contents are indexed for search
+    by database triggers, see chats.search.
     """
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["channel", "seq"], name="chats_message_channel_seq"
+            )
+        ]
+        indexes = [
+            models.Index(
+                fields=["channel", "reaction_seq"], name="chats_message_reaction_seq"
+            ),
+            # Keyset pagination of the history
+            models.Index(
+                fields=["channel", "timestamp", "id"], name="chats_message_history"
+            ),
+        ]
+
     channel = models.ForeignKey(
         to=Channel, on_delete=models.CASCADE, related_name="channel_messages"
     )
@@ -61,10 +216,20 @@ class Message(models.Model):
     )
     content = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
+    # Position within the channel, assigned on creation
+    seq = models.PositiveBigIntegerField(editable=False)
+    # Channel reaction sequence number of the last reaction change, kept in
+    # sync by the reaction triggers
+    reaction_seq = models.PositiveBigIntegerField(default=0, editable=False)
 
     def __str__(self):
         return f"Message: '{self.content}' sent by User: '{self.sender}' in Channel: '{self.channel}'"
 
+    def get_absolute_url(self):
+        """Links to the chat of the channel, opened at this message."""
+        url = reverse("chats:channel-chat", kwargs={"channel_id": self.channel_id})
+        return f"{url}?message={self.id}"
+
 
 class Reaction(models.Model):
     """
@@ -84,3 +249,205 @@ class Reaction(models.Model):
 
     def __str__(self):
         return f"Reaction: '{self.emoji}' by User '{self.reactor}' on Message: '{self.message}'"
+
+    @classmethod
+    def toggle(cls, message_id, reactor_id, emoji, channel_id=None):
+        """
+        Adds the reaction if it does not exist, removes it otherwise, in at
+        most two statements. With `channel_id` only reactions to messages of
+        that channel are toggled. Returns whether the reaction was added, or
+        None when nothing changed, e.g. the message is not in the channel or
+        a concurrent toggle added the reaction first.
+        """
+        reactions = cls.objects.filter(
+            message_id=message_id, reactor_id=reactor_id, emoji=emoji
+        )
+        if channel_id is not None:
+            reactions = reactions.filter(message__channel_id=channel_id)
+        deleted, _ = reactions.delete()
+        if deleted:
+            return False
+
+        # Inserted from a select of the message and the reactor, so a message
+        # outside the channel inserts nothing, as does a reaction added
+        # concurrently
+        params = [
+            emoji,
+            message_id,
+            UserModel._meta.pk.get_db_prep_value(reactor_id, connection),
+        ]
+        condition = ""
+        if channel_id is not None:
+            condition = " AND m.channel_id = %s"
+            params.append(Channel._meta.pk.get_db_prep_value(channel_id, connection))
+        quote_name = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"INSERT INTO {quote_name(cls._meta.db_table)} "
+                "(message_id, reactor_id, emoji) "
+                f"SELECT m.id, u.id, %s FROM {quote_name(Message._meta.db_table)} m, "
+                f"{quote_name(UserModel._meta.db_table)} u "
+                f"WHERE m.id = %s AND u.id = %s{condition} ON CONFLICT DO NOTHING",
+                params,
+            )
+            return True if cursor.rowcount == 1 else None
+
+    @classmethod
+    def emojis_by(cls, reactor_id, message_ids):
+        """
+        Returns the emojis `reactor_id` reacted with on each of `message_ids`
+        that has any, as sets keyed by message id.
+        """
+        emojis = {}
+        reactions = cls.objects.filter(
+            reactor_id=reactor_id, message_id__in=message_ids
+        ).values_list("message_id", "emoji")
+        for message_id, emoji in reactions:
+            emojis.setdefault(message_id, set()).add(emoji)
+        return emojis
+
+
+class ReactionSummary(models.Model):
+    """
+    Represents the number of reactions with an emoji on a message.
+    Maintained by database triggers on the reaction table, so it is updated in
+    the same statement as the reaction itself.
+    """
+
+    class Meta:
+        unique_together = ("message", "emoji")
+
+    message = models.ForeignKey(
+        to=Message, on_delete=models.CASCADE, related_name="reaction_summaries"
+    )
+    emoji = models.CharField(max_length=50)
+    count = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"ReactionSummary: '{self.emoji}' x{self.count} on Message: '{self.message}'"
+
+    @classmethod
+    def counts_for(cls, message_ids):
+        """
+        Returns the reaction counts of each of `message_ids` that has any, as
+        emoji to count dicts keyed by message id, in the order the emojis were
+        first used.
+        """
+        counts = {}
+        summaries = (
+            cls.objects.filter(message_id__in=message_ids)
+            .order_by("id")
+            .values_list("message_id", "emoji", "count")
+        )
+        for message_id, emoji, count in summaries:
+            counts.setdefault(message_id, {})[emoji] = count
+        return counts
+
+
+@receiver(pre_save, sender=Message)
+def assign_message_seq(sender, instance, **kwargs):
+    """
+    Signal to number a new message within its channel and count it.
+    """
+
+    if instance._state.adding and instance.seq is None:
+        instance.seq, _ = Channel.reserve_seq(instance.channel_id)
+
+
+@receiver(post_delete, sender=Message)
+def decrement_message_count(sender, instance, **kwargs):
+    """
+    Signal to uncount a deleted message from its channel.
+    """
+
+    Channel.objects.filter(pk=instance.channel_id, message_count__gt=0).update(
+        message_count=F("message_count") - 1
+    )
+
+
+@receiver(m2m_changed, sender=Channel.members.through)
+def remember_cleared_members(sender, instance, action, reverse, **kwargs):
+    """
+    Signal to remember which memberships a `clear()` removes, as they are not
+    reported to the post_clear handlers below.
+    """
+
+    if action == "pre_clear":
+        related = instance.member_of if reverse else instance.members
+        instance._cleared_membership_pks = list(related.values_list("pk", flat=True))
+
+
+@receiver(m2m_changed, sender=Channel.members.through)
+def update_member_count(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Signal to keep the member counter in sync with channel membership.
+    """
+
+    if action == "post_clear":
+        pk_set = getattr(instance, "_cleared_membership_pks", [])
+
+    if not reverse:
+        channels = Channel.objects.filter(pk=instance.pk)
+    else:
+        channels = Channel.objects.filter(pk__in=pk_set or [])
+
+    if action == "post_add" and pk_set:
+        # Only memberships that did not exist yet are reported
+        added = 1 if reverse else len(pk_set)
+        channels.update(member_count=F("member_count") + added)
+    elif action in ("post_remove", "post_clear"):
+        # Removals may name non-members, so recount instead
+        Channel.rebuild_counters(channels)
+
+
+@receiver(m2m_changed, sender=Channel.members.through)
+def invalidate_membership_cache(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Signal to drop cached membership checks when the membership changes.
+    """
+
+    if action == "post_clear":
+        pk_set = getattr(instance, "_cleared_membership_pks", [])
+    elif action not in ("post_add", "post_remove"):
+        return
+
+    if reverse:
+        keys = [membership_cache_key(pk, instance.pk) for pk in pk_set or []]
+    else:
+        keys = [membership_cache_key(instance.pk, pk) for pk in pk_set or []]
+    cache.delete_many(keys)
+
+
+@receiver(m2m_changed, sender=Channel.members.through)
+def invalidate_sidebar_cache(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Signal to drop the cached sidebars of users joining or leaving a channel.
+    """
+
+    if action == "post_clear":
+        pk_set = getattr(instance, "_cleared_membership_pks", [])
+    elif action not in ("post_add", "post_remove"):
+        return
+
+    user_ids = [instance.pk] if reverse else pk_set or []
+    cache.delete_many([sidebar_cache_key(user_id) for user_id in user_ids])
+
+
+@receiver(post_save, sender=Channel)
+def invalidate_member_sidebars(sender, instance, created, **kwargs):
+    """
+    Signal to drop the cached sidebars of the members of a renamed channel.
+    """
+
+    update_fields = kwargs.get("update_fields")
+    if update_fields is not None and "name" not in update_fields:
+        return
+    renamed = getattr(instance, "_saved_name", None) != instance.name
+    instance._saved_name = instance.name
+    # The owner of a new channel is added as a member afterwards, which
+    # drops their sidebar
+    if created or not renamed:
+        return
+
+    user_ids = instance.members.values_list("pk", flat=True)
+    cache.delete_many([sidebar_cache_key(user_id) for user_id in user_ids])
@@ -0,0 +1,126 @@
+import asyncio
+import itertools
+import logging
+from collections import OrderedDict
+
+from django.conf import settings
+
+from chats.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+COALESCE = "coalesce"
+RESYNC = "resync"
+DISCONNECT = "disconnect"
+
+
+class OutboundQueue:
+    """
+    Bounded queue of frames waiting to be sent to one WebSocket client.
+    Frames are sent by a background task, so a slow client never holds up
+    the consumer's handling of channel layer events. When the queue is full
+    the slow client policy applies:
+
+    - coalesce: pending frames with the same key (e.g. reaction updates of
+      the same message) are replaced by the newest one; if the queue still
+      overflows, it falls back to resync.
+    - resync: pending frames are dropped and replaced by a single
+      `resync_frame` telling the client to reload.
+    - disconnect: the connection is closed.
+    """
+
+    def __init__(self, send, close, resync_frame, max_size=100, policy=COALESCE):
+        self._send = send
+        self._close = close
+        self.resync_frame = resync_frame
+        self.max_size = max_size
+        self.policy = policy
+        self._frames = OrderedDict()
+        self._keys = itertools.count()
+        self._ready = asyncio.Event()
+        self._resyncing = False
+        self._closing = False
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        metrics.incr("outbound.queued", -len(self._frames))
+        self._frames.clear()
+
+    def __len__(self):
+        return len(self._frames)
+
+    def put(self, frame, key=None):
+        """Queues a frame, frames sharing a `key` may be coalesced."""
+        if self._resyncing or self._closing:
+            metrics.incr("outbound.dropped")
+            return
+
+        if self.policy == COALESCE and key is not None and key in self._frames:
+            self._frames[key] = frame
+            metrics.incr("outbound.coalesced")
+            return
+
+        if len(self._frames) >= self.max_size:
+            self._overflow()
+            return
+
+        if key is None or key in self._frames:
+            key = next(self._keys)
+        self._frames[key] = frame
+        metrics.incr("outbound.queued")
+        metrics.max("outbound.queue_depth_max", len(self._frames))
+        self._ready.set()
+
+    def _overflow(self):
+        metrics.incr("outbound.overflows")
+        if self.policy == DISCONNECT:
+            self._closing = True
+            metrics.incr("outbound.disconnects")
+            metrics.incr("outbound.dropped", len(self._frames) + 1)
+            metrics.incr("outbound.queued", -len(self._frames))
+            self._frames.clear()
+            asyncio.create_task(self._close())
+            return
+
+        # The client is too far behind, tell it to reload instead
+        metrics.incr("outbound.resyncs")
+        metrics.incr("outbound.dropped", len(self._frames) + 1)
+        metrics.incr("outbound.queued", 1 - len(self._frames))
+        self._frames.clear()
+        self._frames[RESYNC] = self.resync_frame
+        self._resyncing = True
+        self._ready.set()
+
+    async def _run(self):
+        while True:
+            await self._ready.wait()
+            while self._frames:
+                key, frame = self._frames.popitem(last=False)
+                metrics.incr("outbound.queued", -1)
+                try:
+                    await self._send(frame)
+                except Exception:
+                    logger.exception("Error sending frame")
+                if key == RESYNC:
+                    self._resyncing = False
+            self._ready.clear()
+
+
+def create_outbound_queue(send, close, resync_frame):
+    """Creates an outbound queue configured from the settings."""
+    return OutboundQueue(
+        send,
+        close,
+        resync_frame,
+        max_size=getattr(settings, "CHAT_OUTBOUND_QUEUE_SIZE", 100),
+        policy=getattr(settings, "CHAT_SLOW_CLIENT_POLICY", COALESCE),
+    )
@@ -0,0 +1,124 @@
+import asyncio
+import logging
+from collections import Counter
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+
+from chats.metrics import metrics
+from chats.models import Channel, Message
+
+logger = logging.getLogger(__name__)
+
+
+class MessageWriter:
+    """
+    Write-behind pipeline for incoming chat messages. Messages are queued and
+    saved together with a single bulk_create once `interval` seconds passed
+    or `batch_size` messages are waiting. Batches are written in order, so
+    the ordering of messages within a channel is kept.
+    """
+
+    def __init__(self, enabled=False, interval=0.005, batch_size=100):
+        self.enabled = enabled
+        self.interval = interval
+        self.batch_size = batch_size
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+
+    async def save(self, channel_id, sender, content):
+        """
+        Queues a message and waits until it is saved. Returns the saved
+        message and whether it is the first message of its channel.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        message = Message(channel_id=channel_id, sender=sender, content=content)
+        self._pending.append((message, future))
+
+        if len(self._pending) >= self.batch_size:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.interval, self._start_flush)
+        return await future
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        task = asyncio.create_task(self._flush(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self, batch):
+        messages = [message for message, _ in batch]
+        try:
+            results = await sync_to_async(self._write_batch)(messages)
+            metrics.incr("messages.batches")
+            metrics.incr("messages.batched", len(messages))
+        except Exception:
+            logger.exception("Batched message write failed, saving one by one")
+            metrics.incr("messages.batch_fallbacks")
+            results = await sync_to_async(self._write_each)(messages)
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def _write_batch(self, messages):
+        with transaction.atomic():
+            # bulk_create skips the pre_save signal, number and count the
+            # messages of each channel with one reservation instead
+            last_seqs = {}
+            # Channels without messages before the batch
+            empty = set()
+            for channel_id, added in Counter(
+                message.channel_id for message in messages
+            ).items():
+                last_seqs[channel_id], message_count = Channel.reserve_seq(
+                    channel_id, added
+                )
+                if message_count == added:
+                    empty.add(channel_id)
+            for message in reversed(messages):
+                message.seq = last_seqs[message.channel_id]
+                last_seqs[message.channel_id] -= 1
+            Message.objects.bulk_create(messages)
+
+        results = []
+        for message in messages:
+            results.append((message, message.channel_id in empty))
+            empty.discard(message.channel_id)
+        return results
+
+    def _write_each(self, messages):
+        results = []
+        for message in messages:
+            # Forget anything the failed batch may have assigned
+            message.pk = None
+            message._state.adding = True
+            try:
+                with transaction.atomic():
+                    message.seq, message_count = Channel.reserve_seq(message.channel_id)
+                    message.save()
+                results.append((message, message_count == 1))
+            except Exception as exc:
+                results.append(exc)
+        return results
+
+
+message_writer = MessageWriter(
+    enabled=getattr(settings, "CHAT_MESSAGE_BATCHING", False),
+    interval=getattr(settings, "CHAT_MESSAGE_BATCH_INTERVAL", 0.005),
+    batch_size=getattr(settings, "CHAT_MESSAGE_BATCH_SIZE", 100),
+)
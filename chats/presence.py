@@ -0,0 +1,255 @@
+import asyncio
+import json
+import logging
+import math
+import time
+from collections import Counter
+
+import redis.asyncio
+from django.conf import settings
+from django.template.loader import render_to_string
+
+from chats.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceStore:
+    """
+    Ephemeral presence and typing state of channels, kept in process memory.
+    Each user's entry expires on its own after a TTL and is updated on its
+    own, never by rewriting the state of the whole channel.
+    """
+
+    def __init__(self, online_ttl=60, typing_ttl=5, clock=time.time):
+        self.online_ttl = online_ttl
+        self.typing_ttl = typing_ttl
+        self.clock = clock
+        # Entries by (channel_id, kind), as user id to (name, expiry time)
+        self._entries = {}
+
+    def _ttl(self, kind):
+        return self.online_ttl if kind == "online" else self.typing_ttl
+
+    async def _set(self, channel_id, kind, user_id, name):
+        entries = self._entries.setdefault((channel_id, kind), {})
+        entries[user_id] = (name, self.clock() + self._ttl(kind))
+
+    async def _delete(self, channel_id, kind, user_id):
+        entries = self._entries.get((channel_id, kind), {})
+        entries.pop(user_id, None)
+        if not entries:
+            self._entries.pop((channel_id, kind), None)
+
+    async def _load(self, channel_id, kind):
+        entries = self._entries.get((channel_id, kind), {})
+        now = self.clock()
+        for user_id in [u for u, entry in entries.items() if entry[1] <= now]:
+            del entries[user_id]
+        return entries
+
+    async def set_online(self, channel_id, user_id, name):
+        await self._set(channel_id, "online", user_id, name)
+
+    async def set_typing(self, channel_id, user_id, name):
+        await self._set(channel_id, "typing", user_id, name)
+
+    async def clear_typing(self, channel_id, user_id):
+        await self._delete(channel_id, "typing", user_id)
+
+    async def set_offline(self, channel_id, user_id):
+        await self._delete(channel_id, "online", user_id)
+        await self._delete(channel_id, "typing", user_id)
+
+    async def snapshot(self, channel_id):
+        """Returns the names of online and typing users, by user id."""
+        snapshot = {}
+        for kind in ("online", "typing"):
+            entries = await self._load(channel_id, kind)
+            snapshot[kind] = {
+                user_id: entry[0] for user_id, entry in sorted(entries.items())
+            }
+        return snapshot
+
+
+class RedisPresenceStore(PresenceStore):
+    """
+    Presence and typing state shared by all processes through Redis. Each
+    channel has a hash per kind of state with a field per user, so workers
+    only ever write the fields of their own users. Fields carry their expiry
+    time, as Redis only expires whole keys; a hash expires once none of its
+    users was refreshed for a TTL.
+    """
+
+    def __init__(self, url, **kwargs):
+        super().__init__(**kwargs)
+        self.url = url
+        self._clients = {}
+
+    def _client(self):
+        # Connections belong to the event loop they were opened on
+        loop = asyncio.get_running_loop()
+        if loop not in self._clients:
+            self._clients[loop] = redis.asyncio.Redis.from_url(self.url)
+        return self._clients[loop]
+
+    def _key(self, channel_id, kind):
+        return f"chats:presence:{channel_id}:{kind}"
+
+    async def _set(self, channel_id, kind, user_id, name):
+        key = self._key(channel_id, kind)
+        entry = json.dumps([name, self.clock() + self._ttl(kind)])
+        async with self._client().pipeline(transaction=False) as pipe:
+            pipe.hset(key, user_id, entry)
+            pipe.expire(key, math.ceil(self._ttl(kind)))
+            await pipe.execute()
+
+    async def _delete(self, channel_id, kind, user_id):
+        await self._client().hdel(self._key(channel_id, kind), user_id)
+
+    async def _load(self, channel_id, kind):
+        key = self._key(channel_id, kind)
+        now = self.clock()
+        entries, expired = {}, []
+        for user_id, entry in (await self._client().hgetall(key)).items():
+            name, expires = json.loads(entry)
+            if expires <= now:
+                expired.append(user_id)
+            else:
+                entries[user_id.decode()] = (name, expires)
+        if expired:
+            await self._client().hdel(key, *expired)
+        return entries
+
+
+class PresenceTicker:
+    """
+    Broadcasts presence and typing changes of the channels with connections
+    in this process, at most once per tick and channel as one aggregated
+    frame. Keystrokes only update the store, so the broadcast cost is bounded
+    per channel rather than per keystroke.
+    """
+
+    def __init__(self, store, tick=0.5):
+        self.store = store
+        self.tick = tick
+        # Connections of this process per channel_id and user_id, and when
+        # each user was last refreshed in the store, indexed by channel so a
+        # tick only looks at the users of the channel it broadcasts
+        self._connections = {}
+        self._refreshed = {}
+        self._names = {}
+        self._layers = {}
+        self._last = {}
+        self._task = None
+
+    async def join(self, channel_layer, channel_id, user_id, name):
+        self._connections.setdefault(channel_id, Counter())[user_id] += 1
+        self._refreshed.setdefault(channel_id, {})[user_id] = self.store.clock()
+        self._names[channel_id, user_id] = name
+        self._layers[channel_id] = channel_layer
+        await self.store.set_online(channel_id, user_id, name)
+        if (
+            self._task is None
+            or self._task.done()
+            or self._task.get_loop() is not asyncio.get_running_loop()
+        ):
+            self._task = asyncio.create_task(self._run())
+
+    async def leave(self, channel_id, user_id):
+        connections = self._connections[channel_id]
+        connections[user_id] -= 1
+        if connections[user_id] > 0:
+            return
+        self._refreshed.get(channel_id, {}).pop(user_id, None)
+        # Go offline before the channel may be forgotten, so its last
+        # broadcast does not show the user online
+        await self.store.set_offline(channel_id, user_id)
+        if connections[user_id] <= 0:
+            del connections[user_id]
+            self._names.pop((channel_id, user_id), None)
+        if not connections and self._connections.get(channel_id) is connections:
+            del self._connections[channel_id]
+            self._refreshed.pop(channel_id, None)
+
+    async def typing(self, channel_id, user_id):
+        metrics.incr("presence.typing_events")
+        name = self._names.get((channel_id, user_id), "")
+        await self.store.set_typing(channel_id, user_id, name)
+
+    async def stop_typing(self, channel_id, user_id):
+        await self.store.clear_typing(channel_id, user_id)
+
+    async def _run(self):
+        while self._connections or self._last:
+            await asyncio.sleep(self.tick)
+            for channel_id in self._connections.keys() | self._last.keys():
+                try:
+                    await self._refresh(channel_id)
+                    await self._broadcast(channel_id)
+                except Exception:
+                    logger.exception("Error broadcasting presence")
+
+    async def _refresh(self, channel_id):
+        # Keep local users online for as long as they stay connected
+        now = self.store.clock()
+        refreshed = self._refreshed.get(channel_id, {})
+        for user_id, last in list(refreshed.items()):
+            # Users may leave while others are refreshed
+            if user_id in refreshed and now - last > self.store.online_ttl / 2:
+                refreshed[user_id] = now
+                await self.store.set_online(
+                    channel_id, user_id, self._names[channel_id, user_id]
+                )
+
+    async def _broadcast(self, channel_id):
+        snapshot = await self.store.snapshot(channel_id)
+        if channel_id not in self._connections:
+            # No local connections left, forget the channel after this tick
+            self._last.pop(channel_id, None)
+        elif snapshot == self._last.get(channel_id):
+            return
+        else:
+            self._last[channel_id] = snapshot
+
+        html = render_presence(snapshot)
+        channel_layer = self._layers[channel_id]
+        if channel_id not in self._last:
+            del self._layers[channel_id]
+        await channel_layer.group_send(
+            f"chat_{channel_id}",
+            {"type": "presence_update", "presence": snapshot, "html": html},
+        )
+        metrics.incr("presence.broadcasts")
+
+
+def render_presence(snapshot, exclude_user_id=None):
+    typing = [
+        name
+        for user_id, name in snapshot["typing"].items()
+        if user_id != exclude_user_id
+    ]
+    return render_to_string(
+        "chats/partials/_presence.html",
+        {"online_count": len(snapshot["online"]), "typing": typing},
+    )
+
+
+def create_presence_store():
+    """
+    Creates the presence store configured in the settings, shared through
+    Redis when it is configured.
+    """
+    kwargs = {
+        "online_ttl": getattr(settings, "CHAT_PRESENCE_TTL", 60),
+        "typing_ttl": getattr(settings, "CHAT_TYPING_TTL", 5),
+    }
+    url = getattr(settings, "CHAT_PRESENCE_REDIS_URL", None)
+    if url:
+        return RedisPresenceStore(url, **kwargs)
+    return PresenceStore(**kwargs)
+
+
+presence_ticker = PresenceTicker(
+    create_presence_store(), tick=getattr(settings, "CHAT_PRESENCE_TICK", 0.5)
+)
@@ -0,0 +1,191 @@
+import json
+from urllib.parse import parse_qs
+
+from django.template.loader import render_to_string
+
+from chats.presence import render_presence
+
+JSON_SUBPROTOCOL = "chatlite.json"
+
+ERROR_MESSAGES = {
+    "rate_limited": "You are sending too fast, try again in a moment.",
+}
+
+
+class HtmxProtocol:
+    """
+    The default wire protocol: HTML fragments swapped in out of band by the
+    HTMX WebSocket extension.
+    """
+
+    name = "htmx"
+    subprotocol = None
+
+    def message(self, event):
+        # The fragment is rendered once by the sender, only wrap it here
+        if event["should_group"]:
+            return f'<div hx-swap-oob="beforeend:#message-group-{event["group_id"]} .messages">{event["html"]}</div>'
+
+        html = f'<div hx-swap-oob="beforeend:#chat-log">{event["html"]}</div>'
+        # If it's the first message, also remove the placeholder
+        if event["is_first_message"]:
+            html += '<p id="no-messages-p" hx-swap-oob="delete"></p>'
+        return html
+
+    def reactions(
+        self,
+        message_id,
+        reaction_counts,
+        user_reacted_emojis,
+        user_id,
+        reaction_seq=None,
+    ):
+        # The template does not touch the database so it is rendered without
+        # a thread hop
+        html = render_to_string(
+            "chats/partials/_reactions_list.html",
+            {
+                "message_id": message_id,
+                "reaction_counts": reaction_counts,
+                "user_reacted_emojis": user_reacted_emojis,
+                "current_user_id": user_id,
+            },
+        )
+        html = f'<div id="reactions-for-message-{message_id}" hx-swap-oob="outerHTML">{html}</div>'
+        if reaction_seq is not None:
+            html += self.cursor(reaction_seq)
+        return html
+
+    def presence(self, event, user_id):
+        html = event["html"]
+        if user_id in event["presence"]["typing"]:
+            # Users do not need to see that they are typing themselves
+            html = render_presence(event["presence"], exclude_user_id=user_id)
+        return f'<p id="chat-presence" hx-swap-oob="innerHTML">{html}</p>'
+
+    def batch(self, frames):
+        # Every out of band swap of the fragments is applied in order
+        return "".join(frames)
+
+    def cursor(self, reaction_seq):
+        # Where the next reconnect resumes reaction changes from
+        return f'<div id="chat-cursor" hx-swap-oob="true" data-reaction-seq="{reaction_seq}"></div>'
+
+    def resync(self, url):
+        # Reloads the chat once swapped in by HTMX
+        return (
+            f'<div id="chat-resync" hx-swap-oob="true" hx-get="{url}" '
+            'hx-trigger="load" hx-target="#content"></div>'
+        )
+
+    def error(self, code, kind, retry_after):
+        text = ERROR_MESSAGES.get(code, "Something went wrong.")
+        return (
+            f'<p id="chat-error" class="help is-danger" hx-swap-oob="true" '
+            f'data-code="{code}" data-kind="{kind}" '
+            f'data-retry-after="{retry_after:.2f}">{text}</p>'
+        )
+
+
+class JsonProtocol:
+    """
+    Compact JSON deltas built into DOM nodes by the chat page. Frames are
+    objects with a one letter type `t`:
+
+    - g: a new message group, with the group id `g`, sender id `u`, display
+      name `n`, avatar `a` and the message id `id`, sequence number `s`,
+      content `c` and timestamp `ts`, plus the reactions `r` and `mine` of
+      messages sent while catching up
+    - m: a message continuing group `g`, with `id`, `s`, `u`, `c` and `ts`
+    - b: a batch of frames `f`, sent when catching up after a reconnect
+    - c: the reaction sequence number `r` to resume from on reconnect
+    - r: the reaction counts `c` of message `id`, the emojis the user
+      reacted with `mine` and, when it moved on, the reaction sequence
+      number `rs` to resume from
+    - p: the number of `online` users and the names of those `typing`
+    - resync: the client fell behind and should reload
+    - e: the frame of type `k` was rejected with error `code`, and may be
+      retried after `retry` seconds
+    """
+
+    name = "json"
+    subprotocol = JSON_SUBPROTOCOL
+
+    def _dumps(self, data):
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+
+    def message(self, event):
+        data = event["message"]
+        frame = {
+            "t": "m" if event["should_group"] else "g",
+            "g": event["group_id"],
+            "id": data["id"],
+            "s": data["seq"],
+            "u": data["sender_id"],
+            "c": data["content"],
+            "ts": data["timestamp"],
+        }
+        if not event["should_group"]:
+            frame["n"] = data["display_name"]
+            frame["a"] = data["avatar"]
+        if "reaction_counts" in data:
+            # Messages missed while disconnected may have reactions already
+            frame["r"] = data["reaction_counts"]
+            frame["mine"] = data["user_reacted_emojis"]
+        return self._dumps(frame)
+
+    def reactions(
+        self,
+        message_id,
+        reaction_counts,
+        user_reacted_emojis,
+        user_id,
+        reaction_seq=None,
+    ):
+        frame = {
+            "t": "r",
+            "id": message_id,
+            "c": reaction_counts,
+            "mine": sorted(user_reacted_emojis),
+        }
+        if reaction_seq is not None:
+            frame["rs"] = reaction_seq
+        return self._dumps(frame)
+
+    def presence(self, event, user_id):
+        presence = event["presence"]
+        typing = [name for uid, name in presence["typing"].items() if uid != user_id]
+        return self._dumps(
+            {"t": "p", "online": len(presence["online"]), "typing": typing}
+        )
+
+    def batch(self, frames):
+        # The frames are JSON already
+        return '{"t":"b","f":[' + ",".join(frames) + "]}"
+
+    def cursor(self, reaction_seq):
+        return self._dumps({"t": "c", "r": reaction_seq})
+
+    def resync(self, url):
+        return self._dumps({"t": "resync"})
+
+    def error(self, code, kind, retry_after):
+        return self._dumps(
+            {"t": "e", "code": code, "k": kind, "retry": round(retry_after, 2)}
+        )
+
+
+PROTOCOLS = {protocol.name: protocol for protocol in (HtmxProtocol(), JsonProtocol())}
+
+
+def negotiate(scope):
+    """
+    Picks the wire protocol of a connection from the offered subprotocols or
+    the `protocol` query parameter, defaulting to HTMX.
+    """
+    if JSON_SUBPROTOCOL in scope.get("subprotocols", []):
+        return PROTOCOLS["json"]
+
+    query = parse_qs(scope.get("query_string", b"").decode())
+    name = query.get("protocol", ["htmx"])[0]
+    return PROTOCOLS.get(name, PROTOCOLS["htmx"])
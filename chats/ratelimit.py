@@ -0,0 +1,169 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict
+
+import redis.asyncio
+from django.conf import settings
+
+from chats.metrics import metrics
+
+
+class TokenBucket:
+    """
+    Holds up to `burst` tokens, refilled at `rate` tokens per second. Taking
+    a token from an empty bucket puts it in debt, which later frames wait
+    out.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self):
+        """Seconds until a token is available."""
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+
+class RateLimiter:
+    """
+    Token buckets per user and per channel for each kind of frame, kept in
+    process memory. A frame takes a token from both buckets of its kind and
+    may wait up to `max_delay` seconds for them, otherwise it is rejected
+    without taking any.
+    """
+
+    def __init__(self, limits, max_delay=0.0, max_size=100_000, clock=time.monotonic):
+        self.limits = limits
+        self.max_delay = max_delay
+        self.max_size = max_size
+        self.clock = clock
+        self._buckets = OrderedDict()
+
+    def _bucket(self, key, rate, burst, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(rate, burst, now)
+            while len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket.refill(now)
+        return bucket
+
+    async def acquire(self, kind, user_id, channel_id):
+        """
+        Takes a token for a frame of `kind`. Returns whether the frame is
+        allowed and the seconds it has to wait, or should retry after when
+        it is not.
+        """
+        limits = self.limits.get(kind)
+        if not limits:
+            return True, 0.0
+
+        now = self.clock()
+        buckets = [
+            self._bucket((kind, scope, key), *limits[scope], now)
+            for scope, key in (("user", user_id), ("channel", channel_id))
+            if scope in limits
+        ]
+        wait = max(bucket.wait() for bucket in buckets)
+        if wait > self.max_delay:
+            metrics.incr(f"ratelimit.{kind}.throttled")
+            return False, wait
+
+        for bucket in buckets:
+            bucket.tokens -= 1
+        if wait:
+            metrics.incr(f"ratelimit.{kind}.delayed")
+        return True, wait
+
+
+# Checks the windows of every scope of a frame and counts the frame in all
+# of them only if none is full, in one atomic step. Returns the positions of
+# the full windows, empty when the frame was counted
+CHECK_AND_COUNT = """
+local full = {}
+for i, key in ipairs(KEYS) do
+    if tonumber(redis.call("GET", key) or 0) >= tonumber(ARGV[2 * i - 1]) then
+        table.insert(full, i)
+    end
+end
+if #full == 0 then
+    for i, key in ipairs(KEYS) do
+        if redis.call("INCR", key) == 1 then
+            redis.call("EXPIRE", key, ARGV[2 * i])
+        end
+    end
+end
+return full
+"""
+
+
+class RedisRateLimiter:
+    """
+    Rate limits shared by all processes through Redis, a slower fallback
+    for when limits have to hold across processes: every frame costs a
+    Redis round trip. Each bucket is approximated by a counter of the frames
+    in fixed windows of `burst / rate` seconds, checked and counted by a
+    script, so concurrent frames never both take the last slot and a frame
+    rejected by one scope is not counted by the others. Frames over the
+    limit are rejected until the window ends.
+    """
+
+    def __init__(self, limits, url, clock=time.time):
+        self.limits = limits
+        self.url = url
+        self.clock = clock
+        self._scripts = {}
+
+    def _script(self):
+        # Connections belong to the event loop they were opened on
+        loop = asyncio.get_running_loop()
+        if loop not in self._scripts:
+            client = redis.asyncio.Redis.from_url(self.url)
+            self._scripts[loop] = client.register_script(CHECK_AND_COUNT)
+        return self._scripts[loop]
+
+    async def acquire(self, kind, user_id, channel_id):
+        limits = self.limits.get(kind)
+        if not limits:
+            return True, 0.0
+
+        now = self.clock()
+        keys, args, waits = [], [], []
+        for scope, key in (("user", user_id), ("channel", channel_id)):
+            if scope in limits:
+                rate, burst = limits[scope]
+                window = burst / rate
+                index = int(now // window)
+                keys.append(f"chats:ratelimit:{kind}:{scope}:{key}:{index}")
+                args += [burst, math.ceil(window) + 1]
+                waits.append((index + 1) * window - now)
+
+        full = await self._script()(keys=keys, args=args)
+        if full:
+            metrics.incr(f"ratelimit.{kind}.throttled")
+            return False, max(waits[i - 1] for i in full)
+        return True, 0.0
+
+
+def create_rate_limiter():
+    """Creates the rate limiter configured in the settings."""
+    limits = getattr(settings, "CHAT_RATE_LIMITS", {})
+    if getattr(settings, "CHAT_RATE_LIMIT_BACKEND", "memory") == "redis":
+        return RedisRateLimiter(limits, settings.CHAT_RATE_LIMIT_REDIS_URL)
+    return RateLimiter(
+        limits, max_delay=getattr(settings, "CHAT_RATE_LIMIT_MAX_DELAY", 0.0)
+    )
+
+
+rate_limiter = create_rate_limiter()
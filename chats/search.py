@@ -0,0 +1,118 @@
+import re
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import BooleanField, Max
+from django.db.models.expressions import RawSQL
+
+from chats.models import Membership, Message
+
+# Longer queries are cut, every term narrows the results down anyway
+MAX_TERMS = 10
+
+
+def search_terms(query):
+    """Returns the words of a search query, searched for as plain words."""
+    return re.findall(r"\w+", query)[:MAX_TERMS]
+
+
+def _matches(terms):
+    """
+    Returns a condition on messages containing all `terms`, answered by the
+    full-text index of the database: the FTS5 table on SQLite, the tsvector
+    column on PostgreSQL (see migration 0008).
+    """
+    table = connection.ops.quote_name(Message._meta.db_table)
+    vendor = connection.vendor
+    if vendor == "sqlite":
+        # Quoted terms are never read as FTS5 query syntax
+        return RawSQL(
+            f"{table}.id IN (SELECT rowid FROM chats_message_fts "
+            "WHERE chats_message_fts MATCH %s)",
+            [" ".join(f'"{term}"' for term in terms)],
+            output_field=BooleanField(),
+        )
+    if vendor == "postgresql":
+        return RawSQL(
+            f"{table}.search_vector @@ plainto_tsquery('simple', %s)",
+            [" ".join(terms)],
+            output_field=BooleanField(),
+        )
+    raise NotImplementedError(f"Message search is not available for {vendor}")
+
+
+def search_messages(user, query, before=None, size=None):
+    """
+    Returns up to `size` messages containing every word of `query`, newest
+    first, from the channels `user` is a member of and older than the
+    message id `before`, and the id the next page starts before, or None
+    when there are no more results.
+    """
+    size = size or getattr(settings, "CHAT_SEARCH_PAGE_SIZE", 20)
+    terms = search_terms(query)
+    if not terms:
+        return [], None
+
+    messages = (
+        Message.objects.filter(
+            _matches(terms),
+            channel_id__in=Membership.objects.filter(user_id=user.id).values(
+                "channel_id"
+            ),
+        )
+        .select_related("channel", "sender__profile")
+        .order_by("-id")
+    )
+    if before is not None:
+        messages = messages.filter(id__lt=before)
+
+    results = list(messages[: size + 1])
+    next_page = results[size - 1].id if len(results) > size else None
+    return results[:size], next_page
+
+
+# Indexes the messages with ids in a range, replacing what was indexed before
+REINDEX_BATCH = {
+    "sqlite": "INSERT INTO chats_message_fts (rowid, content) "
+    "SELECT id, content FROM chats_message WHERE id > %s AND id <= %s",
+    "postgresql": "UPDATE chats_message SET search_vector = "
+    "to_tsvector('simple', content) WHERE id > %s AND id <= %s",
+}
+
+
+def reindex_messages(batch_size=1000):
+    """
+    Rebuilds the search index of the existing messages in batches of
+    `batch_size` messages, each written in its own transaction, yielding
+    the number of messages indexed so far. New messages are indexed by the
+    triggers meanwhile.
+
+    On SQLite the index is emptied first, so searches miss the messages
+    not indexed yet until the rebuild is done.
+    """
+    vendor = connection.vendor
+    if vendor not in REINDEX_BATCH:
+        raise NotImplementedError(f"Message search is not available for {vendor}")
+
+    with transaction.atomic():
+        if vendor == "sqlite":
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "INSERT INTO chats_message_fts (chats_message_fts) "
+                    "VALUES ('delete-all')"
+                )
+        # Messages after this one are indexed by the triggers
+        last_id = Message.objects.aggregate(last_id=Max("id"))["last_id"] or 0
+
+    indexed = 0
+    start = 0
+    while start < last_id:
+        ids = Message.objects.filter(id__gt=start, id__lte=last_id).order_by("id")
+        end = next(
+            iter(ids.values_list("id", flat=True)[batch_size - 1 :][:1]), last_id
+        )
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(REINDEX_BATCH[vendor], [start, end])
+            indexed += cursor.rowcount
+        start = end
+        yield indexed
@@ -0,0 +1,36 @@
+from dataclasses import dataclass
+from uuid import UUID
+
+from django.core.cache import cache
+
+from chats.models import SIDEBAR_CACHE_TIMEOUT, sidebar_cache_key
+from chats.unread import read_positions
+
+
+@dataclass
+class SidebarChannel:
+    id: UUID
+    name: str
+    unread: int = 0
+
+
+def sidebar_channels(user):
+    """
+    Returns the channels shown in the sidebar of a user with their unread
+    counts. The channel list is cached until the user joins or creates a
+    channel or one of their channels is renamed; the unread counts come
+    from the read positions on their memberships, in one query.
+    """
+    key = sidebar_cache_key(user.pk)
+    channels = cache.get(key)
+    if channels is None:
+        channels = list(user.member_of.values_list("id", "name"))
+        cache.set(key, channels, SIDEBAR_CACHE_TIMEOUT)
+    if not channels:
+        return []
+
+    unread = read_positions.unread_counts(user.pk)
+    return [
+        SidebarChannel(channel_id, name, unread.get(channel_id, 0))
+        for channel_id, name in channels
+    ]
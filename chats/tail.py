@@ -0,0 +1,108 @@
+import logging
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+from chats.grouping import GroupTail, MessageGrouper, sender_key
+from chats.models import Message
+
+logger = logging.getLogger(__name__)
+
+
+class TailStore:
+    """
+    Keeps the tail of each channel in process memory, backed by the shared
+    cache so other processes and restarts can pick it up. On a full miss the
+    tail is rebuilt from the database.
+    """
+
+    def __init__(self, cache_alias="default", max_size=10_000, timeout=60 * 60 * 24):
+        self.cache_alias = cache_alias
+        self.max_size = max_size
+        self.timeout = timeout
+        self._local = OrderedDict()
+
+    def _key(self, channel_id):
+        return f"chats:tail:{channel_id}"
+
+    def _remember(self, channel_id, tail):
+        self._local[str(channel_id)] = tail
+        self._local.move_to_end(str(channel_id))
+        while len(self._local) > self.max_size:
+            self._local.popitem(last=False)
+
+    def get(self, channel_id, before=None):
+        """
+        Returns the tail of a channel, ignoring message `before` and anything
+        after it when the tail has to be rebuilt from the database.
+
+        Other processes advance the tail too, so with `before` a tail is only
+        used when it ends right before that message: the copy in process
+        memory when this process saw the last message, the shared cache
+        otherwise, and the database when neither is current.
+        """
+        tail = self._local.get(str(channel_id))
+        if tail is not None and (before is None or self._precedes(tail, before)):
+            return tail
+
+        try:
+            data = caches[self.cache_alias].get(self._key(channel_id))
+        except Exception:
+            logger.exception("Failed to read channel tail from cache")
+            data = None
+        tail = GroupTail.from_dict(data) if data is not None else None
+        if tail is None or (before is not None and not self._precedes(tail, before)):
+            tail = self._load(channel_id, before)
+
+        if tail is not None:
+            self._remember(channel_id, tail)
+        return tail
+
+    @staticmethod
+    def _precedes(tail, message):
+        return tail.seq is not None and tail.seq == message.seq - 1
+
+    def set(self, channel_id, tail):
+        self._remember(channel_id, tail)
+        try:
+            caches[self.cache_alias].set(
+                self._key(channel_id), tail.to_dict(), self.timeout
+            )
+        except Exception:
+            logger.exception("Failed to write channel tail to cache")
+
+    def advance(self, channel_id, message):
+        """
+        Moves the tail of a channel to a newly saved message and returns
+        whether the message continues the previous group, and the group id.
+        """
+        grouper = MessageGrouper(self.get(channel_id, before=message))
+        should_group, group_id = grouper.add(message)
+        self.set(channel_id, grouper.tail)
+        return should_group, group_id
+
+    def tail_before(self, channel_id, message):
+        """Rebuilds the tail of a channel as it was before `message`."""
+        return self._load(channel_id, before=message)
+
+    def _load(self, channel_id, before=None):
+        """Rebuilds the tail from the most recent messages of a channel."""
+        messages = Message.objects.filter(channel_id=channel_id).order_by(
+            "-timestamp", "-id"
+        )
+        if before is not None:
+            messages = messages.filter(id__lt=before.id)
+
+        # Walk back to the first message of the last group
+        messages = messages.only("id", "sender_id", "timestamp", "seq").iterator()
+        for group_id, group in MessageGrouper(reverse=True).groups(messages):
+            last = group[-1]
+            return GroupTail(sender_key(last), last.timestamp, group_id, last.seq)
+        return None
+
+
+tail_store = TailStore(
+    cache_alias=getattr(settings, "CHAT_TAIL_CACHE", "default"),
+    max_size=getattr(settings, "CHAT_TAIL_LOCAL_SIZE", 10_000),
+)
@@ -1,10 +1,52 @@
+import asyncio
+import json
+import os
 import uuid
+from datetime import datetime, timedelta
+from datetime import timezone as dt_timezone
+from io import StringIO
+from unittest import mock, skipUnless
 
+from asgiref.testing import ApplicationCommunicator
+from channels.db import database_sync_to_async
+from channels.layers import InMemoryChannelLayer
+from channels.routing import URLRouter
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import IntegrityError
+from django.template.loader import render_to_string
+from django.test import RequestFactory, TestCase, override_settings
 from django.urls import reverse_lazy
 
-from chats.models import Channel, Message, Reaction
+from chatlite.channel_layers import (
+    HashRing,
+    LocalFanoutChannelLayer,
+    ShardedChannelLayer,
+)
+from chatlite.context_processors import sidebar_context
+from chats.broadcast import ReactionCoalescer
+from chats.compression import FrameSizes, create_frame_sizes, offers_deflate
+from chats.consumers import ChatConsumer
+from chats.fragments import fragment_cache
+from chats.grouping import GroupTail, MessageGrouper
+from chats.history import history_page
+from chats.metrics import metrics
+from chats.models import Channel, Membership, Message, Reaction, ReactionSummary
+from chats.outbound import COALESCE, DISCONNECT, RESYNC, OutboundQueue
+from chats.pipeline import MessageWriter
+from chats.presence import (
+    PresenceStore,
+    PresenceTicker,
+    presence_ticker,
+    render_presence,
+)
+from chats.ratelimit import RateLimiter, RedisRateLimiter
+from chats.routing import websocket_urlpatterns
+from chats.search import search_messages
+from chats.sidebar import sidebar_channels
+from chats.tail import TailStore
+from chats.unread import ReadPositions
 
 UserModel = get_user_model()
 
@@ -105,3 +147,1345 @@ class ChatModelsTest(TestCase):
             str(reaction),
             f"Reaction: '👍' by User '{self.user2}' on Message: '{message}'",
         )
+
+    def test_channel_counters(self):
+        self.channel.refresh_from_db()
+        self.assertEqual(self.channel.member_count, 1)
+        self.assertEqual(self.channel.message_count, 0)
+
+        self.channel.members.add(self.user2)
+        self.channel.members.add(self.user2)  # Already a member
+        message = Message.objects.create(
+            channel=self.channel, sender=self.user1, content="Hello everyone!"
+        )
+        self.channel.refresh_from_db()
+        self.assertEqual(self.channel.member_count, 2)
+        self.assertEqual(self.channel.message_count, 1)
+
+        self.user2.member_of.remove(self.channel)
+        message.delete()
+        self.channel.refresh_from_db()
+        self.assertEqual(self.channel.member_count, 1)
+        self.assertEqual(self.channel.message_count, 0)
+
+    def test_rebuild_channel_counters_command(self):
+        Message.objects.create(
+            channel=self.channel, sender=self.user1, content="Hello everyone!"
+        )
+        Channel.objects.update(message_count=10, member_count=10)
+
+        call_command("rebuild_channel_counters", stdout=StringIO())
+        self.channel.refresh_from_db()
+        self.assertEqual(self.channel.message_count, 1)
+        self.assertEqual(self.channel.member_count, 1)
+
+    def test_reaction_toggle_updates_summary(self):
+        message = Message.objects.create(
+            channel=self.channel, sender=self.user1, content="Hello everyone!"
+        )
+
+        with self.assertNumQueries(2):
+            self.assertTrue(Reaction.toggle(message.id, self.user1.id, "👍"))
+        self.assertTrue(Reaction.toggle(message.id, self.user2.id, "👍"))
+        self.assertEqual(ReactionSummary.objects.get(message=message).count, 2)
+
+        with self.assertNumQueries(1):
+            self.assertFalse(Reaction.toggle(message.id, self.user1.id, "👍"))
+        self.assertEqual(ReactionSummary.objects.get(message=message).count, 1)
+
+        self.assertFalse(Reaction.toggle(message.id, self.user2.id, "👍"))
+        self.assertFalse(ReactionSummary.objects.filter(message=message).exists())
+
+    def test_reaction_toggle_is_limited_to_the_channel(self):
+        message = Message.objects.create(
+            channel=self.channel, sender=self.user1, content="Hello everyone!"
+        )
+        other = Channel.objects.create(name="Other", owner=self.user1)
+
+        with self.assertNumQueries(2):
+            self.assertIsNone(
+                Reaction.toggle(message.id, self.user1.id, "👍", other.id)
+            )
+        self.assertTrue(
+            Reaction.toggle(message.id, self.user1.id, "👍", self.channel.id)
+        )
+        with self.assertNumQueries(2):
+            self.assertIsNone(
+                Reaction.toggle(message.id, self.user1.id, "👍", other.id)
+            )
+        self.assertEqual(ReactionSummary.objects.get(message=message).count, 1)
+
+        # A concurrent toggle added the reaction between the two statements
+        with mock.patch("django.db.models.QuerySet.delete", return_value=(0, {})):
+            self.assertIsNone(
+                Reaction.toggle(message.id, self.user1.id, "👍", self.channel.id)
+            )
+        self.assertEqual(ReactionSummary.objects.get(message=message).count, 1)
+
+    def test_messages_and_reactions_are_sequenced(self):
+        messages = [
+            Message.objects.create(channel=self.channel, sender=self.user1, content=c)
+            for c in ("one", "two")
+        ]
+        self.assertEqual([message.seq for message in messages], [1, 2])
+
+        Reaction.toggle(messages[0].id, self.user1.id, "👍")
+        Reaction.toggle(messages[1].id, self.user1.id, "👍")
+        Reaction.toggle(messages[0].id, self.user1.id, "👍")
+        self.channel.refresh_from_db()
+        self.assertEqual(self.channel.last_seq, 2)
+        self.assertEqual(self.channel.reaction_seq, 3)
+        self.assertEqual(
+            list(
+                Message.objects.order_by("seq").values_list("reaction_seq", flat=True)
+            ),
+            [3, 2],
+        )
+
+        # Sequence numbers are never reused
+        messages[1].delete()
+        message = Message.objects.create(
+            channel=self.channel, sender=self.user1, content="three"
+        )
+        self.assertEqual(message.seq, 3)
+
+    def test_channel_is_member_cache_is_invalidated(self):
+        self.assertFalse(Channel.is_member(self.channel.id, self.user2.id))
+        self.channel.members.add(self.user2)
+        self.assertTrue(Channel.is_member(self.channel.id, self.user2.id))
+
+        with self.assertNumQueries(0):
+            self.assertTrue(Channel.is_member(self.channel.id, self.user2.id))
+
+        self.user2.member_of.remove(self.channel)
+        self.assertFalse(Channel.is_member(self.channel.id, self.user2.id))
+        self.channel.members.add(self.user2)
+        self.channel.members.clear()
+        self.assertFalse(Channel.is_member(self.channel.id, self.user2.id))
+        self.assertFalse(Channel.is_member(self.channel.id, self.user1.id))
+
+    def test_membership_unread_messages(self):
+        self.channel.members.add(self.user2)
+        membership = Membership.objects.get(channel=self.channel, user=self.user2)
+        self.assertEqual(membership.last_read_seq, 0)
+
+        for content in ("One", "Two", "Three"):
+            Message.objects.create(
+                channel=self.channel, sender=self.user1, content=content
+            )
+        membership.last_read_seq = 1
+        membership.save()
+        self.assertEqual(
+            [m.content for m in membership.unread_messages().order_by("seq")],
+            ["Two", "Three"],
+        )
+
+
+@override_settings(
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+)
+class ChatConsumerTest(TestCase):
+    def setUp(self):
+        self.user1 = UserModel.objects.create_user(
+            username="testuser1", email="test1@example.com", password="password123"
+        )
+        self.user2 = UserModel.objects.create_user(
+            username="testuser2", email="test2@example.com", password="password123"
+        )
+        self.channel = Channel.objects.create(name="Test Channel", owner=self.user1)
+        self.channel.members.add(self.user2)
+
+        # Keep presence broadcasts out of the frames these tests expect
+        patcher = mock.patch.object(presence_ticker, "tick", 60)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # Start every test with full buckets
+        patcher = mock.patch(
+            "chats.consumers.rate_limiter",
+            RateLimiter({"message": {"user": (5, 10)}}),
+        )
+        self.rate_limiter = patcher.start()
+        self.addCleanup(patcher.stop)
+
+        patcher = mock.patch(
+            "chats.consumers.read_positions", ReadPositions(interval=0.01)
+        )
+        self.read_positions = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def communicator(self, user, subprotocols=(), query_string=b""):
+        # channels.testing pulls in daphne, so drive the ASGI app directly
+        return ApplicationCommunicator(
+            URLRouter(websocket_urlpatterns),
+            {
+                "type": "websocket",
+                "path": f"/ws/chat/{self.channel.id}/",
+                "query_string": query_string,
+                "headers": [],
+                "subprotocols": list(subprotocols),
+                "user": user,
+                "cookies": {},
+            },
+        )
+
+    async def connect(self, user, subprotocols=()):
+        communicator = self.communicator(user, subprotocols)
+        await communicator.send_input({"type": "websocket.connect"})
+        response = await communicator.receive_output()
+        self.assertEqual(response["type"], "websocket.accept")
+        return communicator
+
+    async def send_json(self, communicator, data):
+        await communicator.send_input(
+            {"type": "websocket.receive", "text": json.dumps(data)}
+        )
+
+    async def receive_text(self, communicator):
+        response = await communicator.receive_output()
+        self.assertEqual(response["type"], "websocket.send")
+        return response["text"]
+
+    async def disconnect(self, *communicators):
+        for communicator in communicators:
+            await communicator.send_input(
+                {"type": "websocket.disconnect", "code": 1000}
+            )
+            await communicator.wait()
+
+    async def test_non_member_is_rejected(self):
+        outsider = await UserModel.objects.acreate(
+            username="outsider", email="outsider@example.com"
+        )
+        communicator = self.communicator(outsider)
+        await communicator.send_input({"type": "websocket.connect"})
+        response = await communicator.receive_output()
+        self.assertEqual(response["type"], "websocket.close")
+
+    async def test_message_is_rendered_once_for_all_recipients(self):
+        communicator1 = await self.connect(self.user1)
+        communicator2 = await self.connect(self.user2)
+
+        with mock.patch(
+            "chats.consumers.render_to_string", wraps=render_to_string
+        ) as render:
+            await self.send_json(
+                communicator1, {"type": "message", "content": "Hello!"}
+            )
+            html1 = await self.receive_text(communicator1)
+            html2 = await self.receive_text(communicator2)
+
+        self.assertEqual(render.call_count, 1)
+        self.assertEqual(html1, html2)
+        self.assertIn("Hello!", html1)
+        self.assertIn('hx-swap-oob="delete"', html1)
+
+        await self.disconnect(communicator1, communicator2)
+
+    async def test_messages_over_the_rate_limit_are_rejected(self):
+        self.rate_limiter.limits = {"message": {"user": (0.1, 1)}}
+        communicator = await self.connect(self.user1)
+
+        await self.send_json(communicator, {"type": "message", "content": "First"})
+        self.assertIn("First", await self.receive_text(communicator))
+        await self.send_json(communicator, {"type": "message", "content": "Second"})
+        error = await self.receive_text(communicator)
+
+        self.assertIn('id="chat-error"', error)
+        self.assertIn('data-kind="message"', error)
+        self.assertEqual(await Message.objects.acount(), 1)
+
+        await self.disconnect(communicator)
+
+    async def test_reaction_update_highlights_own_reactions(self):
+        message = await Message.objects.acreate(
+            channel=self.channel, sender=self.user1, content="Hello!"
+        )
+        await Reaction.objects.acreate(message=message, reactor=self.user2, emoji="❤️")
+        communicator1 = await self.connect(self.user1)
+        communicator2 = await self.connect(self.user2)
+
+        await self.send_json(
+            communicator2, {"type": "reaction", "message_id": message.id, "emoji": "👍"}
+        )
+        html1 = await self.receive_text(communicator1)
+        html2 = await self.receive_text(communicator2)
+
+        self.assertEqual(html1.count("is-primary"), 0)
+        self.assertEqual(html2.count("is-primary"), 2)
+        self.assertIn("👍 1", html1)
+        self.assertIn("❤️ 1", html1)
+        # Live updates move the cursor reconnects resume reactions from
+        self.assertIn('id="chat-cursor"', html1)
+        self.assertIn('data-reaction-seq="2"', html1)
+
+        await self.disconnect(communicator1, communicator2)
+
+    @override_settings(CHAT_REACTION_STATE_SIZE=1)
+    async def test_reactions_on_older_messages_are_read_when_they_change(self):
+        older = await Message.objects.acreate(
+            channel=self.channel, sender=self.user1, content="Older"
+        )
+        await Message.objects.acreate(
+            channel=self.channel, sender=self.user1, content="Latest"
+        )
+        await Reaction.objects.acreate(message=older, reactor=self.user2, emoji="❤️")
+        communicator1 = await self.connect(self.user1)
+        communicator2 = await self.connect(self.user2)
+
+        await self.send_json(
+            communicator1, {"type": "reaction", "message_id": older.id, "emoji": "👍"}
+        )
+        html1 = await self.receive_text(communicator1)
+        html2 = await self.receive_text(communicator2)
+
+        self.assertEqual(html1.count("is-primary"), 1)
+        self.assertEqual(html2.count("is-primary"), 1)
+        self.assertIn("❤️ 1", html2)
+
+        await self.disconnect(communicator1, communicator2)
+
+    async def test_reactions_to_messages_of_other_channels_are_rejected(self):
+        other = await Channel.objects.acreate(name="Other", owner=self.user1)
+        message = await Message.objects.acreate(
+            channel=other, sender=self.user1, content="Hello!"
+        )
+        communicator = await self.connect(self.user2)
+
+        with self.assertLogs("chats.consumers", "WARNING"):
+            await self.send_json(
+                communicator,
+                {"type": "reaction", "message_id": message.id, "emoji": "👍"},
+            )
+            self.assertTrue(await communicator.receive_nothing())
+        self.assertFalse(await Reaction.objects.filter(message=message).aexists())
+
+        await self.disconnect(communicator)
+
+    async def test_json_protocol_sends_compact_deltas(self):
+        communicator = self.communicator(self.user1, ["chatlite.json"])
+        await communicator.send_input({"type": "websocket.connect"})
+        response = await communicator.receive_output()
+        self.assertEqual(response["subprotocol"], "chatlite.json")
+        communicator2 = await self.connect(self.user2)
+
+        await self.send_json(communicator, {"type": "message", "content": "<b>Hi"})
+        frame = json.loads(await self.receive_text(communicator))
+        html = await self.receive_text(communicator2)
+        self.assertEqual(frame["t"], "g")
+        self.assertEqual(frame["c"], "<b>Hi")
+        self.assertEqual(frame["u"], str(self.user1.id))
+        self.assertEqual(frame["g"], frame["id"])
+        # HTMX clients on the same channel still get fragments
+        self.assertIn("&lt;b&gt;Hi", html)
+
+        await self.send_json(communicator, {"type": "message", "content": "Again"})
+        frame = json.loads(await self.receive_text(communicator))
+        await self.receive_text(communicator2)
+        self.assertEqual(frame["t"], "m")
+        self.assertNotIn("n", frame)
+
+        await self.send_json(
+            communicator, {"type": "reaction", "message_id": frame["id"], "emoji": "👍"}
+        )
+        frame = json.loads(await self.receive_text(communicator))
+        self.assertEqual(
+            frame,
+            {"t": "r", "id": frame["id"], "c": {"👍": 1}, "mine": ["👍"], "rs": 1},
+        )
+
+        await self.disconnect(communicator, communicator2)
+
+    async def test_reconnect_resumes_missed_messages_and_reactions(self):
+        first = await Message.objects.acreate(
+            channel=self.channel, sender=self.user1, content="Seen"
+        )
+        channel = await Channel.objects.aget(id=self.channel.id)
+        await database_sync_to_async(Reaction.toggle)(first.id, self.user1.id, "👍")
+        await Message.objects.acreate(
+            channel=self.channel, sender=self.user1, content="Missed 1"
+        )
+        await Message.objects.acreate(
+            channel=self.channel, sender=self.user2, content="Missed 2"
+        )
+
+        communicator = self.communicator(
+            self.user2,
+            query_string=f"seq=1&reaction_seq={channel.reaction_seq}".encode(),
+        )
+        await communicator.send_input({"type": "websocket.connect"})
+        await communicator.receive_output()
+        batch = await self.receive_text(communicator)
+        cursor = await self.receive_text(communicator)
+
+        self.assertNotIn("Seen", batch)
+        self.assertLess(batch.index("Missed 1"), batch.index("Missed 2"))
+        self.assertIn(f"#message-group-{first.id} .messages", batch)
+        self.assertIn(f'id="reactions-for-message-{first.id}"', batch)
+        self.assertIn(f'data-reaction-seq="{channel.reaction_seq + 1}"', cursor)
+        await self.disconnect(communicator)
+
+    async def test_reconnect_after_a_large_gap_reloads(self):
+        await Message.objects.abulk_create(
+            Message(channel=self.channel, sender=self.user1, content="m", seq=seq)
+            for seq in range(1, 203)
+        )
+        await Channel.objects.filter(id=self.channel.id).aupdate(last_seq=202)
+
+        communicator = self.communicator(
+            self.user2, query_string=b"seq=1&reaction_seq=0"
+        )
+        await communicator.send_input({"type": "websocket.connect"})
+        await communicator.receive_output()
+        self.assertIn('id="chat-resync"', await self.receive_text(communicator))
+        await self.disconnect(communicator)
+
+    async def test_read_positions_are_written_in_one_batch(self):
+        communicator1 = await self.connect(self.user1)
+        communicator2 = await self.connect(self.user2)
+        batches = metrics.get("read_positions.batches")
+
+        for content in ("One", "Two"):
+            await self.send_json(communicator1, {"type": "message", "content": content})
+            await self.receive_text(communicator1)
+            await self.receive_text(communicator2)
+        await asyncio.sleep(0.05)
+
+        self.assertEqual(metrics.get("read_positions.batches"), batches + 1)
+        read = Membership.objects.filter(channel=self.channel).values_list(
+            "last_read_seq", flat=True
+        )
+        self.assertEqual([seq async for seq in read], [2, 2])
+        await self.disconnect(communicator1, communicator2)
+
+    def test_read_positions_of_a_channel_are_written_together(self):
+        user3 = UserModel.objects.create_user(
+            username="testuser3", email="test3@example.com", password="password123"
+        )
+        self.channel.members.add(user3)
+        positions = ReadPositions()
+        batch = {
+            (str(self.channel.id), str(self.user1.id)): 2,
+            (str(self.channel.id), str(self.user2.id)): 2,
+            (str(self.channel.id), str(user3.id)): 1,
+        }
+
+        # One update per channel and position, in a savepoint as the test runs
+        # inside a transaction
+        with self.assertNumQueries(4):
+            positions._write_batch(batch)
+        read = Membership.objects.filter(channel=self.channel).values_list(
+            "user_id", "last_read_seq"
+        )
+        self.assertEqual(
+            dict(read),
+            {self.user1.id: 2, self.user2.id: 2, user3.id: 1},
+        )
+
+    def test_message_event_queries(self):
+        consumer = ChatConsumer()
+        consumer.scope = {"user": self.user1}
+        consumer.channel_id = str(self.channel.id)
+        create_message = ChatConsumer.__dict__["_create_message"].func
+
+        event = create_message(consumer, "Hello!")
+        self.assertTrue(event["is_first_message"])
+        self.assertFalse(event["should_group"])
+
+        # Only the channel counter update and the insert are left, in a
+        # savepoint as the test runs inside a transaction
+        with self.assertNumQueries(4):
+            event = create_message(consumer, "Hello again!")
+        self.assertFalse(event["is_first_message"])
+        self.assertTrue(event["should_group"])
+
+    def test_failed_insert_does_not_reserve_a_seq(self):
+        consumer = ChatConsumer()
+        consumer.scope = {"user": self.user1}
+        consumer.channel_id = str(self.channel.id)
+        create_message = ChatConsumer.__dict__["_create_message"].func
+
+        with self.assertRaises(IntegrityError):
+            create_message(consumer, None)
+        self.channel.refresh_from_db()
+        self.assertEqual(self.channel.last_seq, 0)
+        self.assertTrue(create_message(consumer, "Hello!")["is_first_message"])
+
+        # Deleted messages are uncounted, numbers are never reused
+        Message.objects.all().delete()
+        event = create_message(consumer, "Hello again!")
+        self.assertTrue(event["is_first_message"])
+        self.assertEqual(event["seq"], 2)
+
+
+class HistoryPageTest(TestCase):
+    def setUp(self):
+        self.user1 = UserModel.objects.create_user(
+            username="testuser1", email="test1@example.com", password="password123"
+        )
+        self.user2 = UserModel.objects.create_user(
+            username="testuser2", email="test2@example.com", password="password123"
+        )
+        self.channel = Channel.objects.create(name="Test Channel", owner=self.user1)
+        self.channel.members.add(self.user2)
+        start = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+        # Groups of 1, 3, 2 and 3 messages, the second one spanning more than
+        # a grouping window
+        self.messages = []
+        for sender, minutes in [
+            (self.user1, 0),
+            (self.user2, 1),
+            (self.user2, 5),
+            (self.user2, 9),
+            (self.user1, 10),
+            (self.user1, 10),
+            (self.user2, 11),
+            (self.user2, 12),
+            (self.user2, 13),
+        ]:
+            message = Message.objects.create(
+                channel=self.channel, sender=sender, content="Hello"
+            )
+            message.timestamp = start + timedelta(minutes=minutes)
+            message.save(update_fields=["timestamp"])
+            self.messages.append(message)
+
+    def group_ids(self, groups):
+        return [[message.id for message in group["messages"]] for group in groups]
+
+    @override_settings(CHAT_HISTORY_CHUNK_SIZE=2)
+    def test_pages_never_split_groups(self):
+        ids = [message.id for message in self.messages]
+
+        groups, next_page = history_page(self.channel, self.user1, size=2)
+        self.assertEqual(self.group_ids(groups), [ids[4:6], ids[6:9]])
+        self.assertEqual(next_page, (self.messages[4].timestamp, ids[4]))
+
+        groups, next_page = history_page(self.channel, self.user1, next_page, size=2)
+        self.assertEqual(self.group_ids(groups), [ids[0:1], ids[1:4]])
+        self.assertIsNone(next_page)
+
+    def test_page_carries_reactions(self):
+        message = self.messages[-1]
+        Reaction.objects.create(message=message, reactor=self.user1, emoji="👍")
+        Reaction.objects.create(message=message, reactor=self.user2, emoji="👍")
+
+        Reaction.objects.create(message=message, reactor=self.user2, emoji="❤️")
+
+        # The messages, their reaction counts and the user's own reactions
+        with self.assertNumQueries(3):
+            groups, _ = history_page(self.channel, self.user1, size=1)
+        rendered = groups[-1]["messages"][-1]
+        self.assertEqual(rendered.reaction_counts, {"👍": 2, "❤️": 1})
+        self.assertEqual(rendered.user_reacted_emojis, {"👍"})
+        self.assertEqual(groups[-1]["messages"][0].reaction_counts, {})
+
+    def test_unchanged_groups_are_served_from_the_cache(self):
+        metrics.reset()
+        first, _ = history_page(self.channel, self.user1, size=2)
+
+        # Only the messages and the user's own reactions are read
+        with self.assertNumQueries(2):
+            second, _ = history_page(self.channel, self.user1, size=2)
+        self.assertEqual(
+            [group["html"] for group in second], [group["html"] for group in first]
+        )
+        self.assertEqual(fragment_cache.hit_ratio(), 0.5)
+
+        Reaction.objects.create(
+            message=self.messages[-1], reactor=self.user2, emoji="👍"
+        )
+        groups, _ = history_page(self.channel, self.user1, size=2)
+        self.assertEqual(groups[0]["html"], first[0]["html"])
+        self.assertIn("👍 1", groups[1]["html"])
+        # Only the reaction list of the changed message was rendered again
+        self.assertEqual(metrics.get("fragments.reactions.misses"), 6)
+        self.assertEqual(metrics.get("fragments.reactions.hits"), 2)
+
+    @override_settings(CHAT_HISTORY_PAGE_GROUPS=2)
+    def test_chat_page_links_older_history(self):
+        self.client.force_login(self.user1)
+        response = self.client.get(self.channel.get_absolute_url())
+        self.assertEqual(len(response.context["grouped_messages"]), 2)
+        next_page_url = response.context["next_page_url"]
+        self.assertContains(response, 'id="history-sentinel"')
+
+        response = self.client.get(next_page_url)
+        self.assertEqual(len(response.context["grouped_messages"]), 2)
+        self.assertIsNone(response.context["next_page_url"])
+        self.assertNotContains(response, 'id="history-sentinel"')
+
+    def test_history_needs_a_valid_cursor(self):
+        self.client.force_login(self.user1)
+        url = reverse_lazy(
+            "chats:channel-history", kwargs={"channel_id": self.channel.id}
+        )
+        self.assertEqual(self.client.get(url).status_code, 400)
+
+
+class ConditionalGetTest(TestCase):
+    def setUp(self):
+        self.user = UserModel.objects.create_user(
+            username="testuser1", email="test1@example.com", password="password123"
+        )
+        self.channel = Channel.objects.create(name="Test Channel", owner=self.user)
+        Message.objects.create(channel=self.channel, sender=self.user, content="Hi")
+        self.client.force_login(self.user)
+        self.url = self.channel.get_absolute_url()
+        # The first page sets the CSRF cookie, which the ETags depend on
+        self.get(self.url)
+
+    def get(self, url, **headers):
+        return self.client.get(url, headers={"HX-Request": "true", **headers})
+
+    def test_unchanged_chat_is_not_modified(self):
+        etag = self.get(self.url)["ETag"]
+
+        # Only the session, the user and the channel validators are read
+        with self.assertNumQueries(3):
+            response = self.get(self.url, If_None_Match=etag)
+        self.assertEqual(response.status_code, 304)
+
+        Message.objects.create(channel=self.channel, sender=self.user, content="New")
+        response = self.get(self.url, If_None_Match=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_validators_follow_reactions_and_renames(self):
+        etag = self.get(self.url)["ETag"]
+        Reaction.objects.create(
+            message=Message.objects.get(), reactor=self.user, emoji="👍"
+        )
+        reacted = self.get(self.url)["ETag"]
+        self.assertNotEqual(reacted, etag)
+
+        details_url = reverse_lazy(
+            "chats:channel-details", kwargs={"channel_id": self.channel.id}
+        )
+        details_etag = self.get(details_url)["ETag"]
+        self.assertEqual(
+            self.get(details_url, If_None_Match=details_etag).status_code, 304
+        )
+        self.channel.name = "Renamed"
+        self.channel.save()
+        self.assertEqual(
+            self.get(details_url, If_None_Match=details_etag).status_code, 200
+        )
+        self.assertNotEqual(self.get(self.url)["ETag"], reacted)
+
+    def test_validators_follow_profile_changes(self):
+        etag = self.get(self.url)["ETag"]
+        history_url = reverse_lazy(
+            "chats:channel-history", kwargs={"channel_id": self.channel.id}
+        )
+        history_etag = self.get(history_url)["ETag"]
+
+        self.user.profile.display_name = "Renamed"
+        self.user.profile.save()
+        self.assertEqual(self.get(self.url, If_None_Match=etag).status_code, 200)
+        self.assertNotEqual(self.get(history_url)["ETag"], history_etag)
+
+    def test_full_pages_and_other_users_are_not_matched(self):
+        self.assertFalse(self.client.get(self.url).has_header("ETag"))
+
+        etag = self.get(self.url)["ETag"]
+        other = UserModel.objects.create_user(
+            username="testuser2", email="test2@example.com", password="password123"
+        )
+        self.channel.members.add(other)
+        self.client.force_login(other)
+        self.assertEqual(self.get(self.url, If_None_Match=etag).status_code, 200)
+
+
+class SidebarTest(TestCase):
+    def setUp(self):
+        self.user = UserModel.objects.create_user(
+            username="testuser1", email="test1@example.com", password="password123"
+        )
+        self.other = UserModel.objects.create_user(
+            username="testuser2", email="test2@example.com", password="password123"
+        )
+        self.channel = Channel.objects.create(name="Test Channel", owner=self.other)
+        self.channel.members.add(self.user)
+        self.request = RequestFactory().get("/")
+        self.request.user = self.user
+
+    def test_channels_are_only_loaded_when_used(self):
+        with self.assertNumQueries(0):
+            context = sidebar_context(self.request)
+        with self.assertNumQueries(2):
+            self.assertEqual([c.name for c in context["channels"]], ["Test Channel"])
+
+        # The channel list is cached, only the read positions are read
+        with self.assertNumQueries(1):
+            sidebar_channels(self.user)
+
+    def test_cache_is_dropped_on_join_create_and_rename(self):
+        sidebar_channels(self.user)
+
+        self.channel.name = "Renamed"
+        self.channel.save()
+        created = Channel.objects.create(name="Created", owner=self.user)
+        joined = Channel.objects.create(name="Joined", owner=self.other)
+        joined.members.add(self.user)
+
+        self.assertEqual(
+            {c.name for c in sidebar_channels(self.user)},
+            {"Renamed", "Created", "Joined"},
+        )
+        self.assertIn(created.id, {c.id for c in sidebar_channels(self.user)})
+
+    def test_cache_is_kept_on_other_channel_changes(self):
+        sidebar_channels(self.user)
+        channel = Channel.objects.get(id=self.channel.id)
+
+        # Only the channel is written, members are not looked up
+        with self.assertNumQueries(1):
+            channel.generate_invite_code()
+        channel.description = "Described"
+        channel.save()
+        with self.assertNumQueries(1):
+            sidebar_channels(self.user)
+
+    def test_unread_counts_follow_read_positions(self):
+        self.assertEqual(sidebar_channels(self.user)[0].unread, 0)
+
+        for content in ("One", "Two"):
+            Message.objects.create(
+                channel=self.channel, sender=self.other, content=content
+            )
+        self.assertEqual(sidebar_channels(self.user)[0].unread, 2)
+
+        self.client.force_login(self.user)
+        self.client.get(self.channel.get_absolute_url())
+        self.assertEqual(sidebar_channels(self.user)[0].unread, 0)
+
+
+class SearchTest(TestCase):
+    def setUp(self):
+        self.user = UserModel.objects.create_user(
+            username="testuser1", email="test1@example.com", password="password123"
+        )
+        self.other = UserModel.objects.create_user(
+            username="testuser2", email="test2@example.com", password="password123"
+        )
+        self.channel = Channel.objects.create(name="Test Channel", owner=self.user)
+        self.outside = Channel.objects.create(name="Other Channel", owner=self.other)
+        self.client.force_login(self.user)
+
+    def send(self, content, channel=None):
+        return Message.objects.create(
+            channel=channel or self.channel, sender=self.user, content=content
+        )
+
+    def search(self, query, **kwargs):
+        return [m.content for m in search_messages(self.user, query, **kwargs)[0]]
+
+    def test_results_are_scoped_to_member_channels(self):
+        self.send("Deploy went fine")
+        self.send("Deploy is broken", channel=self.outside)
+        self.send("Lunch?")
+
+        self.assertEqual(self.search("deploy"), ["Deploy went fine"])
+        self.assertEqual(self.search("DEPLOY fine"), ["Deploy went fine"])
+        self.assertEqual(self.search("deploy broken"), [])
+
+        response = self.client.get(reverse_lazy("chats:search"), {"q": "deploy"})
+        self.assertContains(response, "Deploy went fine")
+        self.assertNotContains(response, "Deploy is broken")
+
+    def test_query_syntax_is_searched_literally(self):
+        self.send("Hello NEAR world")
+
+        self.assertEqual(self.search('"hello NEAR'), ["Hello NEAR world"])
+        self.assertEqual(self.search("near*"), ["Hello NEAR world"])
+        self.assertEqual(self.search("( ) *"), [])
+
+    def test_results_are_keyset_paginated(self):
+        for i in range(5):
+            self.send(f"status report {i}")
+
+        results, next_page = search_messages(self.user, "report", size=2)
+        self.assertEqual(
+            [m.content for m in results], ["status report 4", "status report 3"]
+        )
+        results, next_page = search_messages(
+            self.user, "report", before=next_page, size=2
+        )
+        self.assertEqual(
+            [m.content for m in results], ["status report 2", "status report 1"]
+        )
+        results, next_page = search_messages(
+            self.user, "report", before=next_page, size=2
+        )
+        self.assertEqual([m.content for m in results], ["status report 0"])
+        self.assertIsNone(next_page)
+
+        response = self.client.get(
+            reverse_lazy("chats:search"), {"q": "report", "before": "x"}
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_index_follows_edits_and_deletes(self):
+        message = self.send("first draft")
+        message.content = "final version"
+        message.save()
+        self.assertEqual(self.search("draft"), [])
+        self.assertEqual(self.search("final"), ["final version"])
+
+        # Reaction updates of the message leave the index alone
+        Reaction.objects.create(message=message, reactor=self.other, emoji="👍")
+        self.assertEqual(self.search("final"), ["final version"])
+
+        message.delete()
+        self.assertEqual(self.search("final"), [])
+
+    def test_reindex_command_backfills_in_batches(self):
+        for i in range(5):
+            self.send(f"backlog item {i}")
+
+        out = StringIO()
+        call_command("reindex_messages", batch_size=2, verbosity=2, stdout=out)
+
+        self.assertIn("Indexed 2 messages", out.getvalue())
+        self.assertIn("Indexed 5 messages", out.getvalue())
+        self.assertEqual(len(self.search("backlog")), 5)
+
+    def test_chat_opens_at_a_result(self):
+        messages = [self.send(f"line {i}") for i in range(15)]
+        url = messages[2].get_absolute_url()
+
+        response = self.client.get(url)
+        self.assertContains(response, f'data-anchor="{messages[2].id}"')
+        self.assertContains(response, "line 2")
+        # Newer messages beyond the context are linked, not followed live
+        self.assertNotContains(response, "line 14")
+        self.assertNotContains(response, "ws-connect")
+        self.assertContains(response, "Jump to the latest messages")
+
+        response = self.client.get(messages[10].get_absolute_url())
+        self.assertContains(response, "line 14")
+        self.assertContains(response, "ws-connect")
+
+        other = Message.objects.create(
+            channel=self.outside, sender=self.other, content="Elsewhere"
+        )
+        url = f"{self.channel.get_absolute_url()}?message={other.id}"
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
+class TailStoreTest(TestCase):
+    def setUp(self):
+        self.user1 = UserModel.objects.create_user(
+            username="testuser1", email="test1@example.com", password="password123"
+        )
+        self.user2 = UserModel.objects.create_user(
+            username="testuser2", email="test2@example.com", password="password123"
+        )
+        self.channel = Channel.objects.create(name="Test Channel", owner=self.user1)
+        self.store = TailStore()
+
+    def create_message(self, sender, minutes):
+        message = Message.objects.create(
+            channel=self.channel, sender=sender, content="Hello"
+        )
+        message.timestamp = self.start + timedelta(minutes=minutes)
+        message.save(update_fields=["timestamp"])
+        return message
+
+    @property
+    def start(self):
+        return datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+
+    def test_advance_groups_within_window(self):
+        first = self.create_message(self.user1, 0)
+        self.assertEqual(self.store.advance(self.channel.id, first), (False, first.id))
+
+        second = self.create_message(self.user1, 4)
+        self.assertEqual(self.store.advance(self.channel.id, second), (True, first.id))
+
+        third = self.create_message(self.user2, 5)
+        self.assertEqual(self.store.advance(self.channel.id, third), (False, third.id))
+
+        fourth = self.create_message(self.user2, 11)
+        self.assertEqual(
+            self.store.advance(self.channel.id, fourth), (False, fourth.id)
+        )
+
+    def test_get_rebuilds_tail_from_database(self):
+        first = self.create_message(self.user1, 0)
+        self.create_message(self.user1, 3)
+        last = self.create_message(self.user1, 6)
+        new = self.create_message(self.user1, 8)
+
+        tail = self.store.get(self.channel.id, before=new)
+        self.assertEqual(
+            tail, GroupTail(str(self.user1.id), last.timestamp, first.id, last.seq)
+        )
+
+    def test_tails_advanced_by_other_processes_are_picked_up(self):
+        # Two processes share the cache but not their copies in memory
+        other = TailStore()
+        first = self.create_message(self.user1, 0)
+        self.store.advance(self.channel.id, first)
+        second = self.create_message(self.user2, 1)
+        self.assertEqual(other.advance(self.channel.id, second), (False, second.id))
+
+        third = self.create_message(self.user1, 2)
+        self.assertEqual(self.store.advance(self.channel.id, third), (False, third.id))
+
+        # Without the cache, the database has the last word
+        cache.delete(self.store._key(self.channel.id))
+        fourth = self.create_message(self.user2, 3)
+        self.assertEqual(other.advance(self.channel.id, fourth), (False, fourth.id))
+
+
+class MessageGrouperTest(TestCase):
+    def setUp(self):
+        start = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+        self.messages = [
+            Message(id=i, sender_id=sender_id, timestamp=start + timedelta(minutes=m))
+            for i, (sender_id, m) in enumerate(
+                [(1, 0), (1, 4), (1, 8), (2, 9), (2, 20), (1, 21)], start=1
+            )
+        ]
+
+    def test_groups_stream_lazily(self):
+        consumed = []
+
+        def messages():
+            for message in self.messages:
+                consumed.append(message.id)
+                yield message
+
+        groups = MessageGrouper().groups(messages())
+        group_id, group = next(groups)
+        self.assertEqual((group_id, [m.id for m in group]), (1, [1, 2, 3]))
+        # Only the message ending the group has been read past it
+        self.assertEqual(consumed, [1, 2, 3, 4])
+        self.assertEqual(
+            [(group_id, [m.id for m in group]) for group_id, group in groups],
+            [(4, [4]), (5, [5]), (6, [6])],
+        )
+
+    def test_reverse_groups_match_forward_groups(self):
+        forward = [
+            (group_id, [m.id for m in group])
+            for group_id, group in MessageGrouper().groups(self.messages)
+        ]
+        backward = [
+            (group_id, [m.id for m in group])
+            for group_id, group in MessageGrouper(reverse=True).groups(
+                reversed(self.messages)
+            )
+        ]
+        self.assertEqual(backward, forward[::-1])
+
+    def test_resumes_from_a_tail(self):
+        tail = GroupTail("1", self.messages[0].timestamp - timedelta(minutes=1), 99)
+        grouper = MessageGrouper(tail)
+        self.assertEqual(grouper.add(self.messages[0]), (True, 99))
+        self.assertEqual(grouper.tail.group_id, 99)
+        self.assertEqual(grouper.add(self.messages[3]), (False, 4))
+
+
+class ReactionCoalescerTest(TestCase):
+    async def test_toggles_within_window_are_broadcast_once(self):
+        channel_layer = InMemoryChannelLayer()
+        channel_name = await channel_layer.new_channel()
+        await channel_layer.group_add("chat_test", channel_name)
+        coalescer = ReactionCoalescer(window=0.05)
+
+        async def get_counts(message_id):
+            return {"👍": 2}, 7
+
+        suppressed = metrics.get("reactions.broadcasts_suppressed")
+        for reactor_id in ("a", "b"):
+            await coalescer.add(
+                channel_layer,
+                "chat_test",
+                "1",
+                {"reactor_id": reactor_id, "emoji": "👍", "added": True},
+                get_counts,
+            )
+
+        event = await channel_layer.receive(channel_name)
+        self.assertEqual(event["reaction_counts"], {"👍": 2})
+        self.assertEqual(event["reaction_seq"], 7)
+        self.assertEqual([t["reactor_id"] for t in event["toggles"]], ["a", "b"])
+        self.assertEqual(metrics.get("reactions.broadcasts_suppressed"), suppressed + 1)
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(channel_layer.receive(channel_name), 0.1)
+
+
+class MessageWriterTest(TestCase):
+    def setUp(self):
+        self.user = UserModel.objects.create_user(
+            username="testuser1", email="test1@example.com", password="password123"
+        )
+        self.channel = Channel.objects.create(name="Test Channel", owner=self.user)
+
+    async def test_messages_are_saved_in_one_batch(self):
+        writer = MessageWriter(enabled=True, interval=0.01)
+        batches = metrics.get("messages.batches")
+
+        results = await asyncio.gather(
+            *(writer.save(self.channel.id, self.user, f"m{i}") for i in range(3))
+        )
+
+        self.assertEqual(metrics.get("messages.batches"), batches + 1)
+        self.assertEqual(
+            [message.content for message, _ in results], ["m0", "m1", "m2"]
+        )
+        self.assertEqual([is_first for _, is_first in results], [True, False, False])
+        ids = [message.id for message, _ in results]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual([message.seq for message, _ in results], [1, 2, 3])
+        await self.channel.arefresh_from_db()
+        self.assertEqual(self.channel.message_count, 3)
+
+    async def test_failed_batch_falls_back_to_single_saves(self):
+        writer = MessageWriter(enabled=True, interval=0.01)
+
+        results = await asyncio.gather(
+            writer.save(self.channel.id, self.user, "valid"),
+            writer.save(uuid.uuid4(), self.user, "invalid"),
+            return_exceptions=True,
+        )
+
+        message, is_first = results[0]
+        self.assertTrue(is_first)
+        self.assertTrue(await Message.objects.filter(id=message.id).aexists())
+        self.assertIsInstance(results[1], Exception)
+        self.assertEqual(await Message.objects.acount(), 1)
+
+
+class OutboundQueueTest(TestCase):
+    async def make_queue(self, policy):
+        self.sent = []
+        self.closed = False
+        self.gate = asyncio.Event()
+
+        async def send(frame):
+            await self.gate.wait()
+            self.sent.append(frame)
+
+        async def close():
+            self.closed = True
+
+        queue = OutboundQueue(send, close, "resync", max_size=2, policy=policy)
+        queue.start()
+        # The first frame blocks in send until the gate opens
+        queue.put("first")
+        await asyncio.sleep(0)
+        return queue
+
+    async def flush(self, queue):
+        self.gate.set()
+        for _ in range(10):
+            await asyncio.sleep(0)
+        await queue.stop()
+
+    async def test_coalesce_policy_replaces_pending_frames(self):
+        queue = await self.make_queue(COALESCE)
+        queue.put("reaction 1", key=("reaction", "1"))
+        queue.put("message")
+        queue.put("reaction 1 again", key=("reaction", "1"))
+        self.assertEqual(len(queue), 2)
+
+        await self.flush(queue)
+        self.assertEqual(self.sent, ["first", "reaction 1 again", "message"])
+
+    async def test_resync_policy_replaces_backlog_with_marker(self):
+        queue = await self.make_queue(RESYNC)
+        for i in range(3):
+            queue.put(f"message {i}")
+        queue.put("dropped while resyncing")
+
+        await self.flush(queue)
+        self.assertEqual(self.sent, ["first", "resync"])
+
+    async def test_disconnect_policy_closes_connection(self):
+        queue = await self.make_queue(DISCONNECT)
+        for i in range(3):
+            queue.put(f"message {i}")
+
+        await self.flush(queue)
+        self.assertTrue(self.closed)
+        self.assertEqual(self.sent, ["first"])
+
+
+class PresenceTickerTest(TestCase):
+    async def test_typing_is_broadcast_once_per_tick(self):
+        channel_layer = InMemoryChannelLayer()
+        channel_name = await channel_layer.new_channel()
+        await channel_layer.group_add("chat_1", channel_name)
+        ticker = PresenceTicker(PresenceStore(), tick=0.05)
+
+        await ticker.join(channel_layer, "1", "a", "Alice")
+        await ticker.join(channel_layer, "1", "b", "Bob")
+        for _ in range(5):
+            await ticker.typing("1", "a")
+
+        event = await channel_layer.receive(channel_name)
+        self.assertEqual(event["presence"]["online"], {"a": "Alice", "b": "Bob"})
+        self.assertEqual(event["presence"]["typing"], {"a": "Alice"})
+        self.assertIn("2 online · Alice is typing", event["html"])
+        self.assertNotIn(
+            "typing", render_presence(event["presence"], exclude_user_id="a")
+        )
+
+        # Nothing changed, so nothing is broadcast on the next tick
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(channel_layer.receive(channel_name), 0.1)
+
+        await ticker.leave("1", "a")
+        await ticker.leave("1", "b")
+        # A tick may land between the two leaves, the last broadcast is empty
+        event = await channel_layer.receive(channel_name)
+        if event["presence"]["online"]:
+            event = await channel_layer.receive(channel_name)
+        self.assertEqual(event["presence"]["online"], {})
+        # Channels without local connections are no longer looked at
+        self.assertEqual(ticker._connections, {})
+        self.assertEqual(ticker._refreshed, {})
+
+    async def test_entries_expire_and_update_per_user(self):
+        now = [0.0]
+        store = PresenceStore(online_ttl=60, typing_ttl=5, clock=lambda: now[0])
+        await store.set_online("1", "a", "Alice")
+        await store.set_online("1", "b", "Bob")
+        await store.set_typing("1", "a", "Alice")
+
+        now[0] = 10.0
+        await store.set_offline("1", "b")
+        self.assertEqual(
+            await store.snapshot("1"), {"online": {"a": "Alice"}, "typing": {}}
+        )
+
+
+class FrameSizesTest(TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.frame = render_to_string(
+            "chats/partials/_reactions_list.html",
+            {"message_id": 1, "reaction_counts": {"👍": 2}, "user_reacted_emojis": []},
+        )
+
+    def test_context_takeover_compresses_repeated_markup(self):
+        frame_sizes = FrameSizes(context_takeover=True)
+        raw, first = frame_sizes.record("reaction", self.frame)
+        _, second = frame_sizes.record("reaction", self.frame)
+        self.assertLess(first, raw)
+        self.assertLess(second, first / 2)
+
+        without_takeover = FrameSizes(context_takeover=False)
+        without_takeover.record("reaction", self.frame)
+        _, repeated = without_takeover.record("reaction", self.frame)
+        self.assertEqual(repeated, first)
+
+        self.assertEqual(metrics.get("frames.reaction.count"), 4)
+        self.assertEqual(metrics.get("frames.reaction.raw_bytes"), 4 * raw)
+
+    def test_uncompressed_connections_count_raw_bytes(self):
+        raw, compressed = FrameSizes(compressed=False).record("message", self.frame)
+        self.assertEqual(raw, compressed)
+        self.assertEqual(metrics.get("frames.message.compressed_bytes"), raw)
+
+    def test_accounting_is_off_by_default_and_sampled(self):
+        scope = {"headers": []}
+        self.assertIsNone(create_frame_sizes(scope))
+        with override_settings(
+            CHAT_FRAME_ACCOUNTING=True, CHAT_FRAME_ACCOUNTING_SAMPLE=1
+        ):
+            self.assertIsInstance(create_frame_sizes(scope), FrameSizes)
+        with (
+            override_settings(
+                CHAT_FRAME_ACCOUNTING=True, CHAT_FRAME_ACCOUNTING_SAMPLE=10
+            ),
+            mock.patch("chats.compression.random.randrange", return_value=3),
+        ):
+            self.assertIsNone(create_frame_sizes(scope))
+
+    def test_offers_deflate(self):
+        headers = [
+            (b"sec-websocket-extensions", b"permessage-deflate; client_max_window_bits")
+        ]
+        self.assertTrue(offers_deflate({"headers": headers}))
+        self.assertFalse(offers_deflate({"headers": []}))
+
+
+class RateLimiterTest(TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.now = 0.0
+        self.limiter = RateLimiter(
+            {"message": {"user": (1, 2), "channel": (10, 3)}},
+            clock=lambda: self.now,
+        )
+
+    async def test_bursts_then_refills(self):
+        self.assertEqual(await self.limiter.acquire("message", "1", "a"), (True, 0.0))
+        self.assertEqual(await self.limiter.acquire("message", "1", "a"), (True, 0.0))
+        self.assertEqual(await self.limiter.acquire("message", "1", "a"), (False, 1.0))
+        # Other users keep their own buckets
+        self.assertTrue((await self.limiter.acquire("message", "2", "a"))[0])
+
+        self.now = 1.0
+        self.assertTrue((await self.limiter.acquire("message", "1", "a"))[0])
+        self.assertEqual(metrics.get("ratelimit.message.throttled"), 1)
+
+    async def test_channel_bucket_is_shared_by_users(self):
+        for user_id in "123":
+            self.assertTrue((await self.limiter.acquire("message", user_id, "a"))[0])
+        allowed, wait = await self.limiter.acquire("message", "4", "a")
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(wait, 0.1)
+        # The rejected frame took no token from the user bucket
+        self.assertEqual(await self.limiter.acquire("message", "4", "b"), (True, 0.0))
+
+    async def test_frames_wait_up_to_the_max_delay(self):
+        self.limiter.max_delay = 1.0
+        await self.limiter.acquire("message", "1", "a")
+        await self.limiter.acquire("message", "1", "a")
+        self.assertEqual(await self.limiter.acquire("message", "1", "a"), (True, 1.0))
+        # Waiting frames put the bucket in debt
+        self.assertEqual(await self.limiter.acquire("message", "1", "a"), (False, 2.0))
+        self.assertEqual(metrics.get("ratelimit.message.delayed"), 1)
+
+    async def test_unlimited_kinds_are_allowed(self):
+        self.assertEqual(await self.limiter.acquire("typing", "1", "a"), (True, 0.0))
+
+
+@skipUnless(os.environ.get("REDIS_URL"), "needs a Redis server in REDIS_URL")
+class RedisRateLimiterTest(TestCase):
+    def setUp(self):
+        self.now = 0.0
+
+    def limiter(self, limits):
+        return RedisRateLimiter(
+            limits, os.environ["REDIS_URL"], clock=lambda: 1000.5 + self.now
+        )
+
+    async def test_frames_are_counted_per_window(self):
+        limiter = self.limiter({"message": {"user": (1, 2)}})
+        user_id = str(uuid.uuid4())
+        self.assertTrue((await limiter.acquire("message", user_id, "a"))[0])
+        self.assertTrue((await limiter.acquire("message", user_id, "a"))[0])
+        self.assertEqual(await limiter.acquire("message", user_id, "a"), (False, 1.5))
+
+        self.now = 1.5
+        self.assertTrue((await limiter.acquire("message", user_id, "a"))[0])
+
+    async def test_rejections_do_not_count_in_other_scopes(self):
+        limiter = self.limiter({"message": {"user": (1, 2), "channel": (1, 2)}})
+        user_id, channel_id = str(uuid.uuid4()), str(uuid.uuid4())
+        await limiter.acquire("message", str(uuid.uuid4()), channel_id)
+        await limiter.acquire("message", str(uuid.uuid4()), channel_id)
+        # The full channel rejects the frame without using up the user's window
+        self.assertFalse((await limiter.acquire("message", user_id, channel_id))[0])
+        self.assertFalse((await limiter.acquire("message", user_id, channel_id))[0])
+        self.assertTrue((await limiter.acquire("message", user_id, "a"))[0])
+        self.assertTrue((await limiter.acquire("message", user_id, "a"))[0])
+        self.assertFalse((await limiter.acquire("message", user_id, "a"))[0])
+
+
+IN_MEMORY_SHARDS = [
+    {"NAME": f"shard-{i}", "BACKEND": "channels.layers.InMemoryChannelLayer"}
+    for i in range(3)
+]
+
+
+class ShardedChannelLayerTest(TestCase):
+    def test_adding_a_node_only_moves_keys_to_it(self):
+        keys = [f"chat_{uuid.uuid4()}" for _ in range(1000)]
+        before = HashRing(["a", "b", "c"])
+        after = HashRing(["a", "b", "c", "d"])
+
+        moved = [key for key in keys if before.get(key) != after.get(key)]
+        self.assertTrue(all(after.get(key) == "d" for key in moved))
+        self.assertLess(len(moved), len(keys) * 0.4)
+        self.assertEqual({before.get(key) for key in keys}, {"a", "b", "c"})
+
+    async def test_groups_are_spread_over_shards(self):
+        layer = ShardedChannelLayer(IN_MEMORY_SHARDS)
+        groups = [f"chat_{i}" for i in range(20)]
+        channel_name = await layer.new_channel()
+        for group in groups:
+            await layer.group_add(group, channel_name)
+
+        self.assertGreater(len({id(layer.shard_for(group)) for group in groups}), 1)
+        for group in groups:
+            await layer.group_send(group, {"type": "chat.message", "group": group})
+        received = {(await layer.receive(channel_name))["group"] for _ in groups}
+        self.assertEqual(received, set(groups))
+
+        await layer.group_discard(groups[0], channel_name)
+        await layer.group_send(groups[0], {"type": "chat.message"})
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(layer.receive(channel_name), 0.05)
+
+
+@override_settings(
+    CHANNEL_LAYERS={
+        "default": {
+            "BACKEND": "chatlite.channel_layers.ShardedChannelLayer",
+            "CONFIG": {"shards": IN_MEMORY_SHARDS},
+        }
+    }
+)
+class ShardedChatConsumerTest(ChatConsumerTest):
+    """
+    Runs the consumer tests against several in-memory layers standing in for
+    Redis shards.
+    """
+
+
+class LocalFanoutChannelLayerTest(TestCase):
+    def setUp(self):
+        self.layer = LocalFanoutChannelLayer(
+            {"BACKEND": "channels.layers.InMemoryChannelLayer"}
+        )
+
+    async def test_group_messages_cross_the_inner_layer_once_per_process(self):
+        channel_names = [await self.layer.new_channel() for _ in range(5)]
+        for channel_name in channel_names:
+            await self.layer.group_add("chat_1", channel_name)
+
+        with mock.patch.object(
+            self.layer.inner, "send", wraps=self.layer.inner.send
+        ) as send:
+            await self.layer.group_send("chat_1", {"type": "chat.message"})
+            for channel_name in channel_names:
+                message = await self.layer.receive(channel_name)
+                self.assertEqual(message, {"type": "chat.message"})
+        self.assertEqual(send.call_count, 1)
+
+        for channel_name in channel_names:
+            await self.layer.group_discard("chat_1", channel_name)
+        self.assertNotIn("chat_1", self.layer.inner.groups)
+        await self.layer.flush()
+
+    async def test_direct_sends_go_through_the_inner_layer(self):
+        channel_name = await self.layer.new_channel()
+        await self.layer.group_add("chat_1", channel_name)
+
+        await self.layer.send(channel_name, {"type": "direct"})
+        await self.layer.group_send("chat_1", {"type": "group"})
+        received = {(await self.layer.receive(channel_name))["type"] for _ in "ab"}
+        self.assertEqual(received, {"direct", "group"})
+        await self.layer.flush()
+
+
+@override_settings(
+    CHANNEL_LAYERS={
+        "default": {
+            "BACKEND": "chatlite.channel_layers.LocalFanoutChannelLayer",
+            "CONFIG": {"inner": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+        }
+    }
+)
+class LocalFanoutChatConsumerTest(ChatConsumerTest):
+    """
+    Runs the consumer tests with group messages fanned out in process.
+    """
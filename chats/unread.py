@@ -0,0 +1,90 @@
+import asyncio
+import logging
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.db import transaction
+
+from chats.metrics import metrics
+from chats.models import Membership
+
+logger = logging.getLogger(__name__)
+
+
+class ReadPositions:
+    """
+    Read positions of channel members, stored on their memberships as the
+    sequence number of the last message they read. Consumers report every
+    message they show; reports are merged in memory and written together
+    once `interval` seconds passed. Members of a channel who read up to the
+    same message are moved with one update, so a busy channel costs about
+    one update per interval rather than one per member and message.
+    """
+
+    def __init__(self, interval=2.0):
+        self.interval = interval
+        self._pending = {}
+        self._timer = None
+        self._tasks = set()
+
+    def mark_read(self, channel_id, user_id, seq):
+        """Moves the read position of a member forward to `seq` right away."""
+        Membership.objects.filter(
+            channel_id=channel_id, user_id=user_id, last_read_seq__lt=seq
+        ).update(last_read_seq=seq)
+
+    def report(self, channel_id, user_id, seq):
+        """Queues a read position to be written with the next batch."""
+        key = (str(channel_id), str(user_id))
+        if seq > self._pending.get(key, 0):
+            self._pending[key] = seq
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                self.interval, self._start_flush
+            )
+
+    def _start_flush(self):
+        self._timer = None
+        batch, self._pending = self._pending, {}
+        if not batch:
+            return
+
+        task = asyncio.create_task(self._flush(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self, batch):
+        try:
+            await database_sync_to_async(self._write_batch)(batch)
+            metrics.incr("read_positions.batches")
+            metrics.incr("read_positions.written", len(batch))
+        except Exception:
+            logger.exception("Failed to write read positions")
+
+    def _write_batch(self, batch):
+        readers = {}
+        for (channel_id, user_id), seq in batch.items():
+            readers.setdefault((channel_id, seq), []).append(user_id)
+        with transaction.atomic():
+            for (channel_id, seq), user_ids in readers.items():
+                Membership.objects.filter(
+                    channel_id=channel_id, user_id__in=user_ids, last_read_seq__lt=seq
+                ).update(last_read_seq=seq)
+
+    def unread_counts(self, user_id):
+        """
+        Returns the number of unread messages in each channel of a user, from
+        the read positions and the latest sequence numbers of the channels.
+        """
+        memberships = Membership.objects.filter(user_id=user_id).values_list(
+            "channel_id", "channel__last_seq", "last_read_seq"
+        )
+        return {
+            channel_id: max(0, last_seq - last_read_seq)
+            for channel_id, last_seq, last_read_seq in memberships
+        }
+
+
+read_positions = ReadPositions(
+    interval=getattr(settings, "CHAT_READ_POSITIONS_INTERVAL", 2.0)
+)
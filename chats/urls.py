@@ -2,19 +2,27 @@ from django.urls import path
 
 from chats.views import (
     ChannelChatView,
+    ChannelHistoryView,
     ChannelView,
     CreateChannelView,
     GenerateInviteCodeView,
     HomeView,
     JoinChannelView,
+    SearchView,
 )
 
 app_name = "chats"
 
 urlpatterns = [
     path("", HomeView.as_view(), name="home"),
+    path("search/", SearchView.as_view(), name="search"),
     path("channel/create/", CreateChannelView.as_view(), name="channel-create"),
     path("channel/<uuid:channel_id>/", ChannelChatView.as_view(), name="channel-chat"),
+    path(
+        "channel/<uuid:channel_id>/history/",
+        ChannelHistoryView.as_view(),
+        name="channel-history",
+    ),
     path(
         "channel/<uuid:channel_id>/details/",
         ChannelView.as_view(),
@@ -1,9 +1,34 @@
+from datetime import datetime
+from urllib.parse import urlencode
+
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.http import HttpResponseBadRequest
 from django.shortcuts import get_object_or_404, redirect, render
+from django.urls import reverse
 from django.views.generic import CreateView, TemplateView, View
 
+from chats.conditional import (
+    chat_etag,
+    conditional_page,
+    details_etag,
+    history_etag,
+)
 from chats.forms import ChannelCreateForm, ChannelUpdateForm, MessageForm
+from chats.history import history_page, newer_keyset
 from chats.models import Channel
+from chats.search import search_messages
+from chats.unread import read_positions
+
+
+def history_url(channel, next_page):
+    """Returns the URL of the history page before the keyset `next_page`."""
+    if next_page is None:
+        return None
+    timestamp, message_id = next_page
+    query = urlencode({"before_ts": timestamp.isoformat(), "before_id": message_id})
+    return (
+        f"{reverse('chats:channel-history', kwargs={'channel_id': channel.id})}?{query}"
+    )
 
 
 class HomeView(LoginRequiredMixin, TemplateView):
@@ -13,76 +38,98 @@ class HomeView(LoginRequiredMixin, TemplateView):
 class ChannelChatView(LoginRequiredMixin, TemplateView):
     template_name = "chats/channel_chat.html"
 
+    @conditional_page(chat_etag)
     def get(self, request, channel_id):
         channel = get_object_or_404(Channel, id=channel_id)
 
-        if request.user not in channel.members.all():
+        if not Channel.is_member(channel.id, request.user.id):
             return render(request, "unauthorized.html")
 
-        messages = (
-            channel.channel_messages.order_by("timestamp")
-            .select_related("sender__profile")
-            .prefetch_related("message_reactions__reactor")
-        )
-
-        grouped_messages = []
-        current_group = None
-
-        for message in messages:
-            # Process reactions for each message
-            reaction_counts = {}
-            user_reacted_emojis = set()
-            for reaction in message.message_reactions.all():
-                reaction_counts.setdefault(reaction.emoji, 0)
-                reaction_counts[reaction.emoji] += 1
-                if reaction.reactor == request.user:
-                    user_reacted_emojis.add(reaction.emoji)
-
-            message.reaction_counts = reaction_counts
-            message.user_reacted_emojis = user_reacted_emojis
-
-            if (
-                current_group
-                and current_group["sender"] == message.sender
-                and (
-                    message.timestamp - current_group["last_timestamp"]
-                ).total_seconds()
-                < 60 * 5  # Group messages within 5 minutes
-            ):
-                current_group["messages"].append(message)
-                current_group["last_timestamp"] = message.timestamp
-            else:
-                if current_group:
-                    grouped_messages.append(current_group)
-                current_group = {
-                    "sender": message.sender,
-                    "avatar": (
-                        message.sender.profile.profile_picture
-                        if hasattr(message.sender, "profile")
-                        and message.sender.profile.profile_picture
-                        else "/static/images/default_avatar.png"
-                    ),
-                    "display_name": (
-                        message.sender.profile.display_name
-                        if hasattr(message.sender, "profile")
-                        else message.sender.username
-                    ),
-                    "messages": [message],
-                    "start_timestamp": message.timestamp,
-                    "last_timestamp": message.timestamp,
-                }
-        if current_group:
-            grouped_messages.append(current_group)
+        # Search results open the chat at a message, with newer messages
+        # linked rather than followed live when they do not fit the page
+        anchor = newer_page = None
+        if "message" in request.GET:
+            try:
+                message_id = int(request.GET["message"])
+            except ValueError:
+                return HttpResponseBadRequest("Invalid message id")
+            anchor = get_object_or_404(channel.channel_messages, id=message_id)
+            newer_page = newer_keyset(channel, anchor)
+
+        grouped_messages, next_page = history_page(channel, request.user, newer_page)
+        if newer_page is None:
+            read_positions.mark_read(channel.id, request.user.id, channel.last_seq)
 
         context = {
             "channel": channel,
-            "members_count": channel.members.count(),
+            "members_count": channel.member_count,
             "grouped_messages": grouped_messages,
+            "next_page_url": history_url(channel, next_page),
+            "anchor": anchor,
+            "is_live": newer_page is None,
             "form": MessageForm(),
+            # Wire protocol of the chat socket, HTMX fragments by default
+            "protocol": "json" if request.GET.get("protocol") == "json" else "htmx",
         }
         return render(request, self.template_name, context)
 
 
+class ChannelHistoryView(LoginRequiredMixin, View):
+    template_name = "chats/partials/_history_page.html"
+
+    @conditional_page(history_etag)
+    def get(self, request, channel_id):
+        channel = get_object_or_404(Channel, id=channel_id)
+
+        if not Channel.is_member(channel.id, request.user.id):
+            return render(request, "unauthorized.html")
+
+        try:
+            before = (
+                datetime.fromisoformat(request.GET["before_ts"]),
+                int(request.GET["before_id"]),
+            )
+        except (KeyError, ValueError):
+            return HttpResponseBadRequest("Invalid history cursor")
+
+        grouped_messages, next_page = history_page(channel, request.user, before)
+        context = {
+            "grouped_messages": grouped_messages,
+            "next_page_url": history_url(channel, next_page),
+        }
+        return render(request, self.template_name, context)
+
+
+class SearchView(LoginRequiredMixin, View):
+    template_name = "chats/search.html"
+    results_template_name = "chats/partials/_search_results.html"
+
+    def get(self, request):
+        query = request.GET.get("q", "")
+        before = None
+        if "before" in request.GET:
+            try:
+                before = int(request.GET["before"])
+            except ValueError:
+                return HttpResponseBadRequest("Invalid search cursor")
+
+        results, next_page = search_messages(request.user, query, before)
+        next_page_url = None
+        if next_page is not None:
+            params = urlencode({"q": query, "before": next_page})
+            next_page_url = f"{reverse('chats:search')}?{params}"
+
+        context = {
+            "query": query,
+            "results": results,
+            "next_page_url": next_page_url,
+        }
+        # Later pages are appended to the results shown
+        if before is not None:
+            return render(request, self.results_template_name, context)
+        return render(request, self.template_name, context)
+
+
 class CreateChannelView(LoginRequiredMixin, CreateView):
     template_name = "chats/channel_create.html"
     form_class = ChannelCreateForm
@@ -103,6 +150,10 @@ class ChannelView(LoginRequiredMixin, TemplateView):
     template_name = "chats/channel_view.html"
     unauthorized_template_name = "unauthorized.html"
 
+    @conditional_page(details_etag)
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         channel_id = self.kwargs.get("channel_id")
@@ -144,8 +195,10 @@ class JoinChannelView(LoginRequiredMixin, View):
 
         user = request.user
         # if the user is not a member we add them and redirect to the chat
-        if user not in channel.members.all():
+        if not Channel.is_member(channel.id, user.id):
             channel.members.add(user)
+            # Only messages sent after joining count as unread
+            read_positions.mark_read(channel.id, user.id, channel.last_seq)
         return redirect(channel.get_absolute_url())
 
 
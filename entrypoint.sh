@@ -15,8 +15,8 @@ python manage.py collectstatic --noinput --clear
 
 if [ "$DEBUG" = "True" ]; then
     log "Starting Django with reload"
-    uvicorn chatlite.asgi:application --host 0.0.0.0 --port 8000 --reload --reload-include "*.html" --reload-include "*.css" --reload-include "*.svg" --reload-include "*.png"
+    python -m chatlite --host 0.0.0.0 --port 8000 --reload --reload-include "*.html" --reload-include "*.css" --reload-include "*.svg" --reload-include "*.png"
 else
     log "Starting Django"
-    uvicorn chatlite.asgi:application --host 0.0.0.0 --port 8000
+    python -m chatlite --host 0.0.0.0 --port 8000
 fi
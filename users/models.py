@@ -60,6 +60,8 @@ class UserProfile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name="profile")
     display_name = models.CharField(max_length=50, blank=True, null=True)
     profile_picture = models.URLField(blank=True, null=True)
+    # Part of the ETags of chat pages, which show names and pictures
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f"{self.user}: {self.display_name}"